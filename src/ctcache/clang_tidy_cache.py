@@ -15,25 +15,28 @@ the same unchanged source code.
 """
 
 import errno
-import getpass
 import hashlib
+import io
 import json
 import logging
 import os
 import re
-import shlex
-import shutil
-import subprocess
 import sys
-import tempfile
 import time
-import traceback
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-try:
-    import redis
-except ImportError:
-    redis = None
+# Modules which are not needed on every invocation (subprocess, tempfile, shlex,
+# the backend client libraries, etc.) are imported where they are used, to keep
+# the startup time low. See tools/startup_benchmark.py.
+
+# ------------------------------------------------------------------------------
+def import_redis():
+    "Returns the redis module or None if it is not installed."
+    try:
+        import redis
+        return redis
+    except ImportError:
+        return None
 
 # ------------------------------------------------------------------------------
 def getenv_boolean_flag(name: str) -> bool:
@@ -51,6 +54,69 @@ def mkdir_p(path: os.PathLike) -> None:
         else:
             raise
 
+# ------------------------------------------------------------------------------
+# Hash algorithms which can be used for the cache keys, mapped to the ID that
+# is appended to the hex digest in the keys (<hex digest>-<ID>). SHA-1 keys
+# have no ID for compatibility with the existing caches.
+HASH_ALGORITHM_IDS = {"sha1": "", "blake2b": "b2", "xxh3": "x3"}
+
+# ------------------------------------------------------------------------------
+def make_hash(algorithm: str):
+    "Returns a new hash object for the specified algorithm."
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=20)
+    if algorithm == "xxh3":
+        import xxhash
+        return xxhash.xxh3_128()
+    return hashlib.sha1()
+
+# ------------------------------------------------------------------------------
+def which(program: str) -> str:
+    """
+    Returns the path of the executable found in PATH or the program unchanged.
+    A minimal replacement for shutil.which, which is expensive to import.
+    """
+    if os.path.dirname(program):
+        return program
+    for directory in os.getenv("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory or os.curdir, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return program
+
+# ------------------------------------------------------------------------------
+_umask = None
+def file_mode() -> int:
+    "Returns the mode of the newly created files, as limited by the umask."
+    global _umask
+    if _umask is None:
+        # the umask can only be read by setting it
+        _umask = os.umask(0o022)
+        os.umask(_umask)
+    return 0o666 & ~_umask
+
+# ------------------------------------------------------------------------------
+def write_file_atomic(path: os.PathLike, data: bytes) -> None:
+    "Writes data into a file so that readers never see partial content."
+    import tempfile
+
+    directory = os.path.dirname(path)
+    mkdir_p(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            stream.write(data)
+            # mkstemp creates the files readable only by their owner
+            if hasattr(os, "fchmod"):
+                os.fchmod(stream.fileno(), file_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
 # ------------------------------------------------------------------------------
 class ClangTidyCacheOpts:
     "Class holding the parsed command-line options."
@@ -65,9 +131,18 @@ class ClangTidyCacheOpts:
         self._clang_tidy_args = []
         self._compiler_args = []
         self._cache_dir = None
+        self._compile_commands_path = None
         self._compile_commands_db = None
 
         self._strip_list = os.getenv("CTCACHE_STRIP", "").split(os.pathsep)
+        self._strip_regexes = [re.compile(item) for item in self._strip_list if item]
+        self._path_memo = None
+        self._adjusted_chunks = {}
+        self._hash_algorithm = None
+
+        if self.should_run_batch():
+            # The batch mode constructs the options of each translation unit
+            return
 
         args = self._split_compiler_clang_tidy_args(args)
         self._adjust_compiler_args()
@@ -117,7 +192,7 @@ class ClangTidyCacheOpts:
             cdb_path = args[i]
             if os.path.isdir(cdb_path):
                 cdb_path = os.path.join(cdb_path, "compile_commands.json")
-            self._load_compile_command_db(cdb_path)
+            self._compile_commands_path = cdb_path
 
             i += 1
             if i >= len(args):
@@ -181,14 +256,10 @@ class ClangTidyCacheOpts:
             self._log.error("Loading compile command DB failed: {0}".format(repr(err)))
 
     # --------------------------------------------------------------------------
-    def _compiler_args_for(self, filename: os.PathLike) -> List[str]:
-        if self._compile_commands_db is None:
-            return []
-
-        filename = os.path.expanduser(filename)
-        filename = os.path.realpath(filename)
-
-        for command in self._compile_commands_db:
+    def compile_commands_by_path(self) -> dict:
+        "Returns the compile command DB entries keyed by normalized real path."
+        result = {}
+        for command in self._compile_commands_db or []:
             db_filename = command["file"]
             if not os.path.isabs(db_filename):
                 db_dir = command.get("directory", "")
@@ -200,19 +271,52 @@ class ClangTidyCacheOpts:
                         f"without a 'directory' field. "
                         f"Ensure your build system emits absolute paths or includes 'directory'.")
                     continue
+            result.setdefault(ClangTidyCompileDbIndex.normalize(db_filename), command)
+        return result
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _compiler_args_from(command: dict) -> List[str]:
+        import shlex
+
+        try:
+            return shlex.split(command["command"])
+        except KeyError:
             try:
-                if os.path.samefile(filename, db_filename):
-                    try:
-                        return shlex.split(command["command"])
-                    except KeyError:
-                        try:
-                            return command["arguments"]
-                        except:
-                            return ["clang-tidy"]
-            except FileNotFoundError:
-                continue
+                return command["arguments"]
+            except:
+                return ["clang-tidy"]
+
+    # --------------------------------------------------------------------------
+    def _compiler_args_for(self, filename: os.PathLike) -> List[str]:
+        if self._compile_commands_path is None:
+            return []
+
+        filename = os.path.expanduser(filename)
+        index = ClangTidyCompileDbIndex(self._log, self._compile_commands_path)
+        found, command = index.lookup(filename)
+        if not found:
+            self._load_compile_command_db(self._compile_commands_path)
+            if self._compile_commands_db is None:
+                return []
+            commands = self.compile_commands_by_path()
+            index.build(commands)
+            command = commands.get(ClangTidyCompileDbIndex.normalize(filename))
+
+        if command is None:
+            return []
+        return self._compiler_args_from(command)
 
-        return []
+    # --------------------------------------------------------------------------
+    def load_compile_commands(self, filename: os.PathLike) -> dict:
+        """
+        Loads the specified compile command DB, refreshes its index and returns
+        the entries keyed by normalized real path.
+        """
+        self._load_compile_command_db(filename)
+        commands = self.compile_commands_by_path()
+        ClangTidyCompileDbIndex(self._log, filename).build(commands)
+        return commands
 
     # --------------------------------------------------------------------------
     def should_print_dir(self) -> bool:
@@ -249,6 +353,48 @@ class ClangTidyCacheOpts:
         except IndexError:
             return False
 
+    # --------------------------------------------------------------------------
+    def should_run_worker(self) -> bool:
+        try:
+            return self._original_args[0] == "--worker"
+        except IndexError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def should_upload_spool(self) -> bool:
+        try:
+            return self._original_args[0] == "--upload-spool"
+        except IndexError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def should_trim_local(self) -> bool:
+        try:
+            return self._original_args[0] == "--trim"
+        except IndexError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def should_reconcile_stats(self) -> bool:
+        try:
+            return self._original_args[0] == "--reconcile-stats"
+        except IndexError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def should_compact_local(self) -> bool:
+        try:
+            return self._original_args[0] == "--compact"
+        except IndexError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def should_run_batch(self) -> bool:
+        try:
+            return self._original_args[0] == "--batch"
+        except IndexError:
+            return False
+
     # --------------------------------------------------------------------------
     def should_print_usage(self) -> bool:
         return len(self.original_args()) < 1
@@ -271,37 +417,61 @@ class ClangTidyCacheOpts:
         if self._cache_dir:
             return self._cache_dir
 
+        self._cache_dir = os.getenv("CTCACHE_DIR")
+        if self._cache_dir:
+            return self._cache_dir
+
+        import getpass
+
         try:
             user = getpass.getuser()
         except KeyError:
             user = "unknown"
-        self._cache_dir = os.getenv(
-            "CTCACHE_DIR",
-            os.path.join(
-                tempfile.tempdir if tempfile.tempdir else "/tmp", "ctcache-" + user
-            ),
+        # tempfile.tempdir can only be set if the module was already imported
+        tempfile = sys.modules.get("tempfile")
+        self._cache_dir = os.path.join(
+            tempfile.tempdir if tempfile and tempfile.tempdir else "/tmp", "ctcache-" + user
         )
         return self._cache_dir
 
      # --------------------------------------------------------------------------
     def strip_paths(self, text: str) -> str:
-        for item in self._strip_list:
-            text = re.sub(item, '', text)
+        for regex in self._strip_regexes:
+            text = regex.sub('', text)
         return text
 
+    # --------------------------------------------------------------------------
+    def strip_lines(self, lines: Iterable[bytes]) -> Iterator[bytes]:
+        "Line-oriented streaming form of strip_paths working with UTF-8 bytes."
+        for line in lines:
+            yield self.strip_paths(line.decode("utf-8")).encode("utf-8")
+
+    # --------------------------------------------------------------------------
+    def path_memo(self):
+        if self._path_memo is None:
+            self._path_memo = ClangTidyPathMemo(self._log, self)
+        return self._path_memo
+
     # --------------------------------------------------------------------------
     def adjust_chunk(self, x: str) -> bytes:
+        try:
+            return self._adjusted_chunks[x]
+        except KeyError:
+            pass
+        original = x
         x = x.strip()
         r = str().encode("utf8")
         if not x.startswith("# "):
             for w in x.split():
                 w = w.strip('"')
-                if os.path.exists(w):
-                    w = os.path.realpath(w)
+                resolved = self.path_memo().resolve(w)
+                if resolved is not None:
+                    w = resolved
                 w = self.strip_paths(w)
                 w = w.strip()
                 if w:
                     r += w.encode("utf8")
+        self._adjusted_chunks[original] = r
         return r
 
     # --------------------------------------------------------------------------
@@ -324,6 +494,18 @@ class ClangTidyCacheOpts:
     def s3_read_only(self) -> bool:
         return getenv_boolean_flag("CTCACHE_S3_READ_ONLY")
 
+    # --------------------------------------------------------------------------
+    def s3_endpoint_url(self) -> Optional[str]:
+        return os.getenv("CTCACHE_S3_ENDPOINT_URL") or None
+
+    # --------------------------------------------------------------------------
+    def s3_compress(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_S3_COMPRESS")
+
+    # --------------------------------------------------------------------------
+    def s3_pool_size(self) -> int:
+        return int(os.getenv("CTCACHE_S3_POOL_SIZE", "16"))
+
     # --------------------------------------------------------------------------
     def has_gcs(self) -> bool:
         return "CTCACHE_GCS_BUCKET" in os.environ
@@ -348,6 +530,22 @@ class ClangTidyCacheOpts:
     def cache_locally(self) -> bool:
         return getenv_boolean_flag("CTCACHE_LOCAL")
 
+    # --------------------------------------------------------------------------
+    def local_backend(self) -> str:
+        return os.getenv("CTCACHE_LOCAL_BACKEND", "files").lower()
+
+    # --------------------------------------------------------------------------
+    def local_db_path(self) -> os.PathLike:
+        return os.path.join(self.cache_dir, "cache.sqlite")
+
+    # --------------------------------------------------------------------------
+    def local_max_size(self) -> int:
+        return int(os.getenv("CTCACHE_LOCAL_MAX_SIZE", "0"))
+
+    # --------------------------------------------------------------------------
+    def local_max_count(self) -> int:
+        return int(os.getenv("CTCACHE_LOCAL_MAX_COUNT", "0"))
+
     # --------------------------------------------------------------------------
     def no_local_stats(self) -> bool:
         return getenv_boolean_flag("CTCACHE_NO_LOCAL_STATS")
@@ -380,6 +578,30 @@ class ClangTidyCacheOpts:
     def rest_host_read_only(self) -> bool:
         return getenv_boolean_flag("CTCACHE_HOST_READ_ONLY")
 
+    # --------------------------------------------------------------------------
+    def rest_pool_size(self) -> int:
+        return int(os.getenv("CTCACHE_HOST_POOL_SIZE", "10"))
+
+    # --------------------------------------------------------------------------
+    def rest_retries(self) -> int:
+        return int(os.getenv("CTCACHE_HOST_RETRIES", "2"))
+
+    # --------------------------------------------------------------------------
+    def rest_lookup_timeout(self) -> float:
+        return float(os.getenv("CTCACHE_HOST_LOOKUP_TIMEOUT", "3.0"))
+
+    # --------------------------------------------------------------------------
+    def rest_store_timeout(self) -> float:
+        return float(os.getenv("CTCACHE_HOST_STORE_TIMEOUT", "10.0"))
+
+    # --------------------------------------------------------------------------
+    def bloom_filter(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_BLOOM_FILTER")
+
+    # --------------------------------------------------------------------------
+    def bloom_filter_refresh(self) -> float:
+        return float(os.getenv("CTCACHE_BLOOM_FILTER_REFRESH", "300"))
+
     # --------------------------------------------------------------------------
     def save_output(self) -> bool:
         return getenv_boolean_flag("CTCACHE_SAVE_OUTPUT")
@@ -388,6 +610,16 @@ class ClangTidyCacheOpts:
     def ignore_output(self) -> bool:
         return self.save_output() or "CTCACHE_IGNORE_OUTPUT" in os.environ
 
+    # --------------------------------------------------------------------------
+    def compress_output(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_COMPRESS_OUTPUT")
+
+    # --------------------------------------------------------------------------
+    def output_dict_path(self) -> os.PathLike:
+        return os.getenv(
+            "CTCACHE_OUTPUT_DICT",
+            os.path.join(self.cache_dir, "output.zdict"))
+
     # --------------------------------------------------------------------------
     def save_all(self) -> bool:
         return self.save_output() or "CTCACHE_SAVE_ALL" in os.environ
@@ -406,6 +638,7 @@ class ClangTidyCacheOpts:
 
     # --------------------------------------------------------------------------
     def dump_dir(self) -> os.PathLike:
+        import tempfile
         return os.getenv("CTCACHE_DUMP_DIR", tempfile.gettempdir())
 
     # --------------------------------------------------------------------------
@@ -433,6 +666,35 @@ class ClangTidyCacheOpts:
     def exclude_user_config(self) -> bool:
         return getenv_boolean_flag("CTCACHE_EXCLUDE_USER_CONFIG")
 
+    # --------------------------------------------------------------------------
+    def no_config_cache(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_NO_CONFIG_CACHE")
+
+    # --------------------------------------------------------------------------
+    def hash_algorithm(self) -> str:
+        if self._hash_algorithm is None:
+            algorithm = os.getenv("CTCACHE_HASH_ALGORITHM", "sha1").lower()
+            if algorithm not in HASH_ALGORITHM_IDS:
+                self._log.warning(f"Unknown hash algorithm '{algorithm}', using sha1")
+                algorithm = "sha1"
+            elif algorithm == "xxh3":
+                try:
+                    import xxhash
+                except ImportError:
+                    self._log.warning("The xxhash module is not available, using sha1")
+                    algorithm = "sha1"
+            self._hash_algorithm = algorithm
+        return self._hash_algorithm
+
+    # --------------------------------------------------------------------------
+    def no_path_cache(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_NO_PATH_CACHE")
+
+    # --------------------------------------------------------------------------
+    def direct_mode(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_DIRECT_MODE") and \
+            not (self.running_on_msvc() or self.running_on_clang_cl())
+
     # --------------------------------------------------------------------------
     def has_redis_host(self) -> bool:
         return "CTCACHE_REDIS_HOST" in os.environ
@@ -480,6 +742,208 @@ class ClangTidyCacheOpts:
     def redis_read_only(self) -> bool:
         return getenv_boolean_flag("CTCACHE_REDIS_READ_ONLY")
 
+    # --------------------------------------------------------------------------
+    def redis_optimized(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_REDIS_OPTIMIZED")
+
+    # --------------------------------------------------------------------------
+    def parallel_lookup(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_PARALLEL_LOOKUP")
+
+    # --------------------------------------------------------------------------
+    def parallel_lookup_timeout(self) -> float:
+        return float(os.getenv("CTCACHE_PARALLEL_LOOKUP_TIMEOUT", "10.0"))
+
+    # --------------------------------------------------------------------------
+    def write_behind(self) -> bool:
+        return getenv_boolean_flag("CTCACHE_WRITE_BEHIND")
+
+    # --------------------------------------------------------------------------
+    def spool_dir(self) -> os.PathLike:
+        return os.path.join(self.cache_dir, "spool")
+
+    # --------------------------------------------------------------------------
+    def spool_max_size(self) -> int:
+        return int(os.getenv("CTCACHE_SPOOL_MAX_SIZE", str(64 * 1024 * 1024)))
+
+    # --------------------------------------------------------------------------
+    def spool_max_retries(self) -> int:
+        return int(os.getenv("CTCACHE_SPOOL_MAX_RETRIES", "5"))
+
+    # --------------------------------------------------------------------------
+    def worker_socket(self) -> str:
+        return os.getenv(
+            "CTCACHE_WORKER_SOCKET",
+            os.path.join(self.cache_dir, "worker", "worker.sock"))
+
+    # --------------------------------------------------------------------------
+    def worker_max_jobs(self) -> int:
+        return int(os.getenv("CTCACHE_WORKER_MAX_JOBS", "64"))
+
+# ------------------------------------------------------------------------------
+class ClangTidyPathMemo:
+    """
+    Memo of the real paths of argument tokens naming existing file system
+    entries. The entries are grouped by their parent directory and are
+    validated by the mtime of that directory, which changes when entries
+    in it are created, removed or renamed. Unless disabled, the memo is
+    persisted in the cache directory for each working directory (build tree).
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._cwd = os.getcwd()
+        self._dirs = {}
+        self._validated = set()
+        self._changed = False
+        self._path = None
+        if not opts.no_path_cache():
+            self._path = os.path.join(
+                opts.cache_dir, "paths",
+                hashlib.sha1(self._cwd.encode("utf8")).hexdigest())
+            try:
+                with open(self._path, "rb") as stream:
+                    self._dirs = json.loads(stream.read().decode("utf8"))
+            except (OSError, ValueError):
+                pass
+
+    # --------------------------------------------------------------------------
+    def _entries(self, directory: str) -> dict:
+        entry = self._dirs.get(directory)
+        if directory not in self._validated:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime = None
+            if entry is None or entry[0] != mtime:
+                entry = self._dirs[directory] = [mtime, {}]
+                self._changed = True
+            self._validated.add(directory)
+        return entry[1]
+
+    # --------------------------------------------------------------------------
+    def resolve(self, token: str) -> Optional[str]:
+        "Returns the real path of the token or None if it is not an existing path."
+        directory, name = os.path.split(os.path.join(self._cwd, token))
+        entries = self._entries(directory)
+        try:
+            return entries[name]
+        except KeyError:
+            pass
+        resolved = os.path.realpath(token) if os.path.exists(token) else None
+        entries[name] = resolved
+        self._changed = True
+        return resolved
+
+    # --------------------------------------------------------------------------
+    def save(self) -> None:
+        if self._path and self._changed:
+            try:
+                write_file_atomic(self._path, json.dumps(self._dirs).encode("utf8"))
+                self._changed = False
+            except OSError as error:
+                self._log.debug(f"Failed to store path memo: {error}")
+
+# ------------------------------------------------------------------------------
+class ClangTidyCompileDbIndex:
+    """
+    Sidecar index of a compile_commands.json file, stored next to it,
+    which allows to look up the entry for a single source file without loading
+    and scanning the whole compile command DB. The index consists of a header
+    with the size and mtime of the DB, a table of (key, offset, length) records
+    sorted by key, which is the SHA-1 of the normalized real path of the source
+    file, and the JSON-encoded DB entries.
+    """
+    _magic = b"CTCDBIX1"
+    _header = "<8sQQI"
+    _record = "<20sQI"
+
+    # --------------------------------------------------------------------------
+    def __init__(self, log, db_path: os.PathLike):
+        self._log = log
+        self._db_path = db_path
+        self._path = str(db_path) + ".ctcache-index"
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def normalize(path: os.PathLike) -> str:
+        return os.path.normcase(os.path.normpath(os.path.realpath(path)))
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _key(normalized_path: str) -> bytes:
+        return hashlib.sha1(normalized_path.encode("utf8")).digest()
+
+    # --------------------------------------------------------------------------
+    def _db_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self._db_path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    # --------------------------------------------------------------------------
+    def lookup(self, filename: os.PathLike) -> Tuple[bool, Optional[dict]]:
+        """
+        Returns a pair of a flag indicating if the index is valid and the entry
+        for the specified file if it is found.
+        """
+        import mmap
+        import struct
+
+        stamp = self._db_stamp()
+        if stamp is None:
+            return False, None
+        try:
+            with open(self._path, "rb") as stream, \
+                 mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                magic, size, mtime, count = struct.unpack_from(self._header, index, 0)
+                if magic != self._magic or (size, mtime) != stamp:
+                    return False, None
+                key = self._key(self.normalize(filename))
+                table = struct.calcsize(self._header)
+                record_size = struct.calcsize(self._record)
+                data = table + count * record_size
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    rkey, offset, length = struct.unpack_from(
+                        self._record, index, table + mid * record_size)
+                    if rkey < key:
+                        lo = mid + 1
+                    elif rkey > key:
+                        hi = mid
+                    else:
+                        entry = index[data + offset:data + offset + length]
+                        return True, json.loads(entry.decode("utf8"))
+                return True, None
+        except (OSError, ValueError, struct.error) as error:
+            self._log.debug(f"Compile command DB index not usable: {error}")
+            return False, None
+
+    # --------------------------------------------------------------------------
+    def build(self, commands: dict) -> None:
+        "Writes the index for the given entries keyed by normalized path."
+        import struct
+
+        stamp = self._db_stamp()
+        if stamp is None:
+            return
+        records = []
+        blobs = []
+        offset = 0
+        for key, command in sorted(
+                ((self._key(p), c) for p, c in commands.items()), key=lambda kc: kc[0]):
+            blob = json.dumps(command).encode("utf8")
+            records.append(struct.pack(self._record, key, offset, len(blob)))
+            blobs.append(blob)
+            offset += len(blob)
+        header = struct.pack(self._header, self._magic, stamp[0], stamp[1], len(records))
+        try:
+            write_file_atomic(self._path, header + b"".join(records) + b"".join(blobs))
+        except OSError as error:
+            self._log.debug(f"Failed to write compile command DB index: {error}")
+
 # ------------------------------------------------------------------------------
 class ClangTidyCacheHash:
     # --------------------------------------------------------------------------
@@ -488,7 +952,8 @@ class ClangTidyCacheHash:
 
     # --------------------------------------------------------------------------
     def __init__(self, opts):
-        self._hash = hashlib.sha1()
+        self._algorithm = opts.hash_algorithm()
+        self._hash = make_hash(self._algorithm)
         if opts.dump_enabled():
             self._dump = self._opendump(opts)
         else:
@@ -509,20 +974,174 @@ class ClangTidyCacheHash:
 
     # --------------------------------------------------------------------------
     def hexdigest(self):
+        "Returns the cache key, the hex digest followed by the algorithm ID."
+        algorithm_id = HASH_ALGORITHM_IDS[self._algorithm]
+        if algorithm_id:
+            return f"{self._hash.hexdigest()}-{algorithm_id}"
         return self._hash.hexdigest()
 
+# ------------------------------------------------------------------------------
+class ClangTidyBloomFilter:
+    """
+    Read-only view of the Bloom filter of the hashes cached by the server
+    (see BloomFilter in clang_tidy_cache_server.py, which must be kept in sync).
+    The filter is memory-mapped, so only the pages with the tested bits are read.
+    The hashes stored by the client are added to the downloaded file, so that
+    they are not reported as missing until the next refresh.
+    """
+    _magic = b"CTCBLOOM"
+    _header = "<8sII"
+
+    # --------------------------------------------------------------------------
+    def __init__(self, data, bit_count: int, hash_count: int, offset: int):
+        self._data = data
+        self._bit_count = bit_count
+        self._hash_count = hash_count
+        self._offset = offset
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def load(cls, log, path: os.PathLike):
+        "Returns the filter stored in the specified file or None if it is not valid."
+        import mmap
+        import struct
+
+        try:
+            with open(path, "rb") as stream:
+                data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = struct.calcsize(cls._header)
+            magic, bit_count, hash_count = struct.unpack_from(cls._header, data, 0)
+            if magic != cls._magic or bit_count == 0 or len(data) < offset + bit_count // 8:
+                return None
+            return cls(data, bit_count, hash_count, offset)
+        except (OSError, ValueError, struct.error) as error:
+            log.debug(f"Bloom filter not usable: {error}")
+            return None
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def add_to_file(cls, log, path: os.PathLike, digest: str) -> None:
+        "Adds the digest to the filter stored in the specified file, if it is valid."
+        import mmap
+        import struct
+
+        try:
+            with open(path, "r+b") as stream, \
+                 mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_WRITE) as data:
+                offset = struct.calcsize(cls._header)
+                magic, bit_count, hash_count = struct.unpack_from(cls._header, data, 0)
+                if magic != cls._magic or bit_count == 0 or len(data) < offset + bit_count // 8:
+                    return
+                for pos in cls(data, bit_count, hash_count, offset)._positions(digest):
+                    data[offset + (pos >> 3)] |= 1 << (pos & 7)
+        except (OSError, ValueError, struct.error) as error:
+            log.debug(f"Failed to add to the Bloom filter: {error}")
+
+    # --------------------------------------------------------------------------
+    def _positions(self, digest: str):
+        d = hashlib.sha1(digest.encode("utf8")).digest()
+        h1 = int.from_bytes(d[0:8], "little")
+        h2 = int.from_bytes(d[8:16], "little") | 1
+        for i in range(self._hash_count):
+            yield (h1 + i * h2) % self._bit_count
+
+    # --------------------------------------------------------------------------
+    def might_contain(self, digest: str) -> bool:
+        for pos in self._positions(digest):
+            if not self._data[self._offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
 # ------------------------------------------------------------------------------
 class ClangTidyServerCache:
+    stats_name = "server"
+    # Maximal number of digests sent in a single bulk lookup request
+    _batch_size = 1000
+
     def __init__(self, log, opts):
-        import requests
-        self._requests = requests
         self._log = log
         self._opts = opts
+        self._session = self._make_session(opts)
+        self._has_bulk_lookup = True
+        self._bloom_filter = None
+        self._bloom_filter_loaded = False
+        # if set, failed stores raise instead of being only logged
+        self.strict_stores = False
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _make_session(opts):
+        """
+        Returns a session keeping the connections to the server alive,
+        so that they are reused by subsequent requests from the same process.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Requests which may have reached the server (read errors) are not
+        # retried, the idempotent ones are retried on the gateway errors and
+        # at most once immediately on connection errors, so that an unreachable
+        # server does not slow down every lookup.
+        retry = Retry(
+            total=opts.rest_retries(),
+            connect=min(1, opts.rest_retries()),
+            read=0,
+            backoff_factor=0.1,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET", "PUT"])
+        # the failures are reported by the cache, not by each retry
+        logging.getLogger("urllib3").setLevel(logging.ERROR)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=opts.rest_pool_size(),
+            max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    # --------------------------------------------------------------------------
+    def _bloom_filter_path(self) -> os.PathLike:
+        return os.path.join(self._opts.cache_dir, "bloom_filter")
+
+    # --------------------------------------------------------------------------
+    def _refresh_bloom_filter(self, path: os.PathLike) -> None:
+        try:
+            if time.time() - os.path.getmtime(path) < self._opts.bloom_filter_refresh():
+                return
+            # mark the filter as fresh, so that concurrent clients do not download it
+            os.utime(path)
+        except OSError:
+            pass
+        try:
+            query = self._session.get(
+                self._make_bloom_filter_url(), timeout=self._opts.rest_lookup_timeout())
+            # an empty file disables the filter until the next refresh
+            # (for example if the server does not publish it)
+            write_file_atomic(path, query.content if query.status_code == 200 else bytes())
+        except Exception as error:
+            self._log.debug(f"Failed to download the Bloom filter: {error}")
+
+    # --------------------------------------------------------------------------
+    def _might_be_cached(self, digest) -> bool:
+        "Returns False if the digest is definitely not cached by the server."
+        if not self._opts.bloom_filter():
+            return True
+        if not self._bloom_filter_loaded:
+            self._bloom_filter_loaded = True
+            path = self._bloom_filter_path()
+            self._refresh_bloom_filter(path)
+            self._bloom_filter = ClangTidyBloomFilter.load(self._log, path)
+        return self._bloom_filter is None or self._bloom_filter.might_contain(digest)
 
     # --------------------------------------------------------------------------
     def is_cached(self, digest) -> bool:
+        if not self._might_be_cached(digest):
+            return False
         try:
-            query = self._requests.get(self._make_query_url(digest), timeout=3)
+            query = self._session.get(
+                self._make_query_url(digest), timeout=self._opts.rest_lookup_timeout())
             if query.status_code == 200:
                 if query.json() is True:
                     return True
@@ -538,15 +1157,100 @@ class ClangTidyServerCache:
 
     # --------------------------------------------------------------------------
     def get_cache_data(self, digest) -> Optional[bytes]:
+        if not self._might_be_cached(digest):
+            return None
         try:
-            query = self._requests.get(self._make_data_url(digest), timeout=3)
+            query = self._session.get(
+                self._make_data_url(digest), timeout=self._opts.rest_lookup_timeout())
             if query.status_code == 200:
-                return query.text.encode('UTF-8')
+                return self._decode_data(query.content)
         except:
             pass
 
         return None
 
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _encode_data(data: bytes):
+        # the server stores the data as text, compressed outputs are sent in base64
+        if data.startswith(OUTPUT_MAGIC):
+            import base64
+            return OUTPUT_BASE64_PREFIX + base64.b64encode(data)
+        return data
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _decode_data(data: bytes) -> bytes:
+        if data.startswith(OUTPUT_BASE64_PREFIX):
+            import base64
+            return base64.b64decode(data[len(OUTPUT_BASE64_PREFIX):])
+        return data
+
+    # --------------------------------------------------------------------------
+    def fetch_output_dict(self) -> Optional[bytes]:
+        "Returns the output compression dictionary served by the server."
+        try:
+            query = self._session.get(
+                self._make_output_dict_url(), timeout=self._opts.rest_lookup_timeout())
+            if query.status_code == 200:
+                return query.content
+        except:
+            pass
+        return None
+
+    # --------------------------------------------------------------------------
+    def _lookup_many(self, digests: List[str], with_data: bool) -> Optional[dict]:
+        """
+        Queries the server about multiple digests in chunks of limited size.
+        Returns None if the server does not support bulk lookups.
+        """
+        result = {}
+        digests = [digest for digest in digests if self._might_be_cached(digest)]
+        for i in range(0, len(digests), self._batch_size):
+            chunk = digests[i:i + self._batch_size]
+            query = self._session.post(
+                self._make_bulk_url(),
+                json={"digests": chunk, "data": with_data},
+                timeout=self._opts.rest_lookup_timeout() + len(chunk) / 100)
+            if query.status_code in [404, 405]:
+                self._log.debug("Server does not support bulk lookups")
+                self._has_bulk_lookup = False
+                return None
+            if query.status_code != 200:
+                self._log.error("lookup_many: Can't connect to server {0}, error {1}".format(
+                    self._opts.rest_host(), query.status_code))
+                return result
+            result.update(query.json())
+        return result
+
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        if self._has_bulk_lookup:
+            result = {}
+            try:
+                result = self._lookup_many(digests, False)
+            except:
+                pass
+            if result is not None:
+                return {digest: result.get(digest) is True for digest in digests}
+        return {digest: self.is_cached(digest) for digest in digests}
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        if self._has_bulk_lookup:
+            result = {}
+            try:
+                result = self._lookup_many(digests, True)
+            except:
+                pass
+            if result is not None:
+                return {
+                    digest: self._decode_data(result[digest].encode('UTF-8'))
+                        if isinstance(result.get(digest), str) else None
+                    for digest in digests
+                }
+        return {digest: self.get_cache_data(digest) for digest in digests}
+
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
         self.store_in_cache_with_data(digest, bytes())
@@ -561,17 +1265,28 @@ class ClangTidyServerCache:
         if self._opts.rest_host_read_only():
             return
         try:
-            query = self._requests.put(self._make_data_url(digest), data={'data': data}, params=self._auth_params(), timeout=3)
+            query = self._session.put(
+                self._make_data_url(digest),
+                data={'data': self._encode_data(data)},
+                params=self._auth_params(),
+                timeout=self._opts.rest_store_timeout())
             if query.status_code != 200:
-                self._log.error("store_in_cache: Can't store data in server {0}, error {1}".format(
-                    self._opts.rest_host(), query.status_code))
+                message = "store_in_cache: Can't store data in server {0}, error {1}".format(
+                    self._opts.rest_host(), query.status_code)
+                if self.strict_stores:
+                    raise RuntimeError(message)
+                self._log.error(message)
+            elif self._opts.bloom_filter():
+                ClangTidyBloomFilter.add_to_file(self._log, self._bloom_filter_path(), digest)
         except:
-            pass
+            if self.strict_stores:
+                raise
 
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
         try:
-            query = self._requests.get(self._make_stats_url(), timeout=3)
+            query = self._session.get(
+                self._make_stats_url(), timeout=self._opts.rest_lookup_timeout())
             if query.status_code == 200:
                 return query.json()
             else:
@@ -605,151 +1320,362 @@ class ClangTidyServerCache:
         }
 
     # --------------------------------------------------------------------------
-    def _make_stats_url(self) -> str:
-        return "%(proto)s://%(host)s:%(port)d/stats" % {
+    def _make_bulk_url(self) -> str:
+        return "%(proto)s://%(host)s:%(port)d/cache_many" % {
             "proto": self._opts.rest_proto(),
             "host": self._opts.rest_host(),
             "port": self._opts.rest_port()
         }
 
-# ------------------------------------------------------------------------------
-class MultiprocessLock:
     # --------------------------------------------------------------------------
-    def __init__(self, lock_path, timeout=3): # timeout 3 seconds
-        self._lock_path = os.path.abspath(os.path.expanduser(lock_path))
-        self._timeout = timeout
-        self._lock_handle = None
+    def _make_output_dict_url(self) -> str:
+        return "%(proto)s://%(host)s:%(port)d/output_dict" % {
+            "proto": self._opts.rest_proto(),
+            "host": self._opts.rest_host(),
+            "port": self._opts.rest_port()
+        }
 
     # --------------------------------------------------------------------------
-    def acquire(self):
-        start_time = time.time()
-        while True:
-            try:
-                # Attempt to create the lock file exclusively
-                self._lock_handle = os.open(self._lock_path, os.O_CREAT | os.O_EXCL)
-                return self
-            except FileExistsError:
-                # File is locked, check if the timeout has been exceeded
-                if time.time() - start_time > self._timeout:
-                    msg = f"Timeout ({self._timeout} seconds) exceeded while acquiring lock."
-                    raise RuntimeError(msg)
-                # Wait and try again
-                time.sleep(0.1)
-            except FileNotFoundError:
-                # The path to the lock file doesn't exist, create it and retry
-                os.makedirs(os.path.dirname(self._lock_path), exist_ok=True)
+    def _make_bloom_filter_url(self) -> str:
+        return "%(proto)s://%(host)s:%(port)d/bloom_filter" % {
+            "proto": self._opts.rest_proto(),
+            "host": self._opts.rest_host(),
+            "port": self._opts.rest_port()
+        }
 
     # --------------------------------------------------------------------------
-    def release(self):
-        if self._lock_handle is not None:
-            try:
-                os.close(self._lock_handle)
-                os.unlink(self._lock_path)  # Remove the lock file upon release
-            except OSError:
-                pass  # Ignore errors if the file doesn't exist or has already been released
-            finally:
-                self._lock_handle = None
+    def _make_stats_url(self) -> str:
+        return "%(proto)s://%(host)s:%(port)d/stats" % {
+            "proto": self._opts.rest_proto(),
+            "host": self._opts.rest_host(),
+            "port": self._opts.rest_port()
+        }
 
-    # --------------------------------------------------------------------------
-    def __enter__(self):
-        return self.acquire()
-
-    # --------------------------------------------------------------------------
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.release()
+# ------------------------------------------------------------------------------
+# Names of the cache backends recorded in the statistics, indexed by their ID
+STATS_BACKENDS = ["", "local", "server", "redis", "s3", "gcs"]
 
 # ------------------------------------------------------------------------------
 class ClangTidyCacheStats:
+    """
+    Cache statistics kept in the `stats` sub-directory of the cache directory.
+    Each lookup and each clang-tidy run appends a fixed-size record
+    (kind, backend ID, seconds) to the `<name>.log` file, opened with O_APPEND,
+    so the updates never need to lock, wait or rewrite anything.
+    Reading folds the records appended since the previous read into
+    the `<name>.summary` file, so only the new records are read.
+    Large logs are rotated to `<name>.log.old`, which is removed once it was
+    folded and no writer can still append to it. The folding and rotation are
+    serialized by a lock on `<name>.lock`. The per-shard counters written by
+    older versions are folded into the summary on the first read.
+    """
+    _record = "<BBxxf"
+    _record_size = 8
+    _miss = 0
+    _hit = 1
+    _run = 2
+    _rotate_size = 8 * 1024 * 1024
+    _rotate_delay = 10
+
     # --------------------------------------------------------------------------
     def __init__(self, log, opts, name):
         self._log = log
         self._opts = opts
         self._name = name
+        self._dir = os.path.join(opts.cache_dir, "stats")
+        self._log_path = os.path.join(self._dir, name + ".log")
+        self._old_log_path = self._log_path + ".old"
+        self._summary_path = os.path.join(self._dir, name + ".summary")
+        self._lock_path = os.path.join(self._dir, name + ".lock")
 
     # --------------------------------------------------------------------------
-    def stats_file(self, digest):
-        return os.path.join(self._opts.cache_dir, digest[:2], self._name)
+    def _locked(self, function):
+        "Calls the function while holding the lock of the summary."
+        mkdir_p(self._dir)
+        with open(self._lock_path, "a") as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            return function()
 
     # --------------------------------------------------------------------------
-    def read(self):
-        hits, misses = 0, 0
+    def _append(self, kind: int, backend: Optional[str], seconds: float) -> None:
+        import struct
+
+        try:
+            backend_id = STATS_BACKENDS.index(backend or "")
+        except ValueError:
+            backend_id = 0
+        self._write_record(struct.pack(self._record, kind, backend_id, seconds))
+
+    # --------------------------------------------------------------------------
+    def _write_record(self, record: bytes) -> None:
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        try:
+            try:
+                fd = os.open(self._log_path, flags, 0o644)
+            except FileNotFoundError:
+                mkdir_p(self._dir)
+                fd = os.open(self._log_path, flags, 0o644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self._log.error(f"Error writing to file: {e}")
+
+    # --------------------------------------------------------------------------
+    def update(self, digest, hit, backend: Optional[str] = None):
+        self._append(self._hit if hit else self._miss, backend, 0.0)
+
+    # --------------------------------------------------------------------------
+    def record_run(self, seconds: float):
+        "Records the duration of a clang-tidy run, used to estimate the time saved."
+        self._append(self._run, None, seconds)
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _empty_summary() -> dict:
+        return {
+            "offset": 0,
+            "old_offset": 0,
+            "legacy_folded": False,
+            "hits": 0,
+            "misses": 0,
+            "backend_hits": {},
+            "runs": 0,
+            "run_seconds": 0.0
+        }
+
+    # --------------------------------------------------------------------------
+    def _fold_log(self, summary: dict, path: os.PathLike, offset_key: str) -> bool:
+        "Adds the new records from the log to the summary, returns if it exists."
+        import struct
+
+        try:
+            with open(path, "rb") as f:
+                f.seek(summary[offset_key])
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        size = len(data) - len(data) % self._record_size
+        for record in struct.iter_unpack(self._record, data[:size]):
+            self._fold_record(summary, record)
+        summary[offset_key] += size
+        return True
+
+    # --------------------------------------------------------------------------
+    def _fold_record(self, summary: dict, record: tuple) -> None:
+        kind, backend_id, seconds = record
+        if kind == self._hit:
+            summary["hits"] += 1
+            if 0 < backend_id < len(STATS_BACKENDS):
+                backend = STATS_BACKENDS[backend_id]
+                summary["backend_hits"][backend] = summary["backend_hits"].get(backend, 0) + 1
+        elif kind == self._miss:
+            summary["misses"] += 1
+        elif kind == self._run:
+            summary["runs"] += 1
+            summary["run_seconds"] += seconds
+
+    # --------------------------------------------------------------------------
+    def _fold_legacy(self, summary: dict) -> None:
+        # counters of the previous versions, stored in the shard directories
         for i in range(0, 256):
-            digest = f'{i:02x}'
-            file = self.stats_file(digest)
-            if os.path.isfile(file):
-                h, m = self._read(file)
-                hits += h
-                misses += m
-        return hits, misses
-
-    # --------------------------------------------------------------------------
-    def _read(self, file):
-        with MultiprocessLock(file + ".lock") as _:
-            if os.path.isfile(file):
-                with open(file, 'r') as f:
-                    return self.read_from_file(f)
-            return 0,0
-
-    # --------------------------------------------------------------------------
-    def read_from_file(self, f):
-        content = f.read().split()
-        if len(content) == 2:
-            return int(content[0]), int(content[1])
-        else:
-            self._log.error(f"Invalid stats content in: {f.name}")
-        return 0,0
+            shard_file = os.path.join(self._opts.cache_dir, f'{i:02x}', self._name)
+            try:
+                with open(shard_file, "r") as f:
+                    content = f.read().split()
+                if len(content) == 2:
+                    summary["hits"] += int(content[0])
+                    summary["misses"] += int(content[1])
+                os.unlink(shard_file)
+            except (OSError, ValueError):
+                pass
+            try:
+                with open(shard_file + ".log", "rb") as f:
+                    content = f.read()
+                summary["hits"] += content.count(b"h")
+                summary["misses"] += content.count(b"m")
+                os.unlink(shard_file + ".log")
+            except OSError:
+                pass
+        summary["legacy_folded"] = True
 
     # --------------------------------------------------------------------------
-    def write_to_file(self, f, hits, misses, hit):
-        if hit:
-            hits += 1
-        else:
-            misses += 1
-        f.write(f"{hits} {misses}\n")
+    def summary(self) -> dict:
+        "Returns the aggregated statistics and updates the stored summary."
+        return self._locked(self._fold_summary)
 
     # --------------------------------------------------------------------------
-    def update(self, digest, hit):
+    def _fold_summary(self) -> dict:
+        summary = self._empty_summary()
         try:
-            file = self.stats_file(digest)
-            mkdir_p(os.path.dirname(file))
-            with MultiprocessLock(file + ".lock") as _:
-                try:
-                    if os.path.isfile(file):
-                        with open(file, 'r+') as fh:
-                            hits, misses = self.read_from_file(fh)
-                            fh.seek(0)
-                            self.write_to_file(fh, hits, misses, hit)
-                            fh.truncate()
-                    else:
-                        with open(file, 'w') as fh:
-                            self.write_to_file(fh, 0, 0, hit)
-                except IOError as e:
-                    self._log.error(f"Error writing to file: {e}")
-        except Exception as e:
-            traceback.print_exc(file=sys.stdout)
-            raise
+            with open(self._summary_path, "r") as f:
+                summary.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+        if not summary["legacy_folded"]:
+            self._fold_legacy(summary)
+
+        has_old_log = self._fold_log(summary, self._old_log_path, "old_offset")
+        if has_old_log:
+            # the rotated log is removed when the writers which opened it
+            # before the rotation have surely finished appending to it
+            try:
+                if time.time() - os.path.getmtime(self._old_log_path) > self._rotate_delay:
+                    os.unlink(self._old_log_path)
+                    summary["old_offset"] = 0
+                    has_old_log = False
+            except OSError:
+                pass
+
+        if self._fold_log(summary, self._log_path, "offset") and \
+                not has_old_log and summary["offset"] > self._rotate_size:
+            try:
+                os.rename(self._log_path, self._old_log_path)
+                summary["old_offset"] = summary["offset"]
+                summary["offset"] = 0
+            except OSError:
+                pass
+
+        try:
+            write_file_atomic(self._summary_path, json.dumps(summary).encode("utf8"))
+        except OSError as e:
+            self._log.debug(f"Failed to write stats summary: {e}")
+        return summary
+
+    # --------------------------------------------------------------------------
+    def read(self):
+        summary = self.summary()
+        return summary["hits"], summary["misses"]
 
     # --------------------------------------------------------------------------
     def clear(self):
-        for i in range(0, 256):
-            digest = f'{i:02x}'
-            file = self.stats_file(digest)
-            if os.path.isfile(file):
-                os.unlink(file)
+        self._locked(self._clear)
+
+    # --------------------------------------------------------------------------
+    def _clear(self):
+        for path in [self._log_path, self._old_log_path, self._summary_path]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        # drop also the counters of the previous versions
+        self._fold_legacy(self._empty_summary())
+        summary = self._empty_summary()
+        summary["legacy_folded"] = True
+        write_file_atomic(self._summary_path, json.dumps(summary).encode("utf8"))
+
+# ------------------------------------------------------------------------------
+class ClangTidyLocalCacheTotals(ClangTidyCacheStats):
+    """
+    Entry count and total size of the local cache, maintained incrementally.
+    Stores and evictions append (count, size) deltas to `stats/entries.log`,
+    which is folded into the summary like the cache statistics. The first read
+    and an explicit reconciliation establish the totals with a full scan.
+    """
+    _record = "<qq"
+    _record_size = 16
+
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts, scan):
+        ClangTidyCacheStats.__init__(self, log, opts, "entries")
+        self._scan = scan
+
+    # --------------------------------------------------------------------------
+    def add(self, count: int, size: int) -> None:
+        import struct
+
+        self._write_record(struct.pack(self._record, count, size))
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _empty_summary() -> dict:
+        return {
+            "offset": 0,
+            "old_offset": 0,
+            # whether the totals were established by a scan
+            "legacy_folded": False,
+            "count": 0,
+            "size": 0
+        }
+
+    # --------------------------------------------------------------------------
+    def _fold_record(self, summary: dict, record: tuple) -> None:
+        count, size = record
+        summary["count"] += count
+        summary["size"] += size
+
+    # --------------------------------------------------------------------------
+    def _fold_legacy(self, summary: dict) -> None:
+        # the scan supersedes the records logged so far
+        for path, offset_key in [(self._log_path, "offset"), (self._old_log_path, "old_offset")]:
+            try:
+                size = os.path.getsize(path)
+                summary[offset_key] = size - size % self._record_size
+            except OSError:
+                summary[offset_key] = 0
+        summary["count"], summary["size"] = self._scan()
+        summary["legacy_folded"] = True
+
+    # --------------------------------------------------------------------------
+    def read(self) -> Tuple[int, int]:
+        summary = self.summary()
+        return max(0, summary["count"]), max(0, summary["size"])
+
+    # --------------------------------------------------------------------------
+    def reconcile(self) -> Tuple[int, int]:
+        "Recomputes the totals by scanning the whole cache."
+        def _reconcile():
+            try:
+                os.unlink(self._summary_path)
+            except FileNotFoundError:
+                pass
+            summary = self._fold_summary()
+            return max(0, summary["count"]), max(0, summary["size"])
+        return self._locked(_reconcile)
 
 # ------------------------------------------------------------------------------
 class ClangTidyLocalCache:
+    """
+    Cache storing the entries as files in 256 shard directories.
+    If the size or the entry count of the cache is limited, each shard keeps
+    an append-only index of the sizes and access times of its entries and
+    the totals of its entries. A store which makes the shard exceed its share
+    of the limits trims it by evicting the least recently used entries, so
+    the eviction is amortized across the invocations and never needs to walk
+    the whole cache. The index is parsed and compacted only by the trimming.
+    """
+    stats_name = "local"
+    _index_name = ".index"
+    _totals_name = ".totals"
     # --------------------------------------------------------------------------
     def __init__(self, log, opts):
         self._log = log
         self._opts = opts
-        self._hash_regex = re.compile(r'^[0-9a-f]{38}$')
+        self._shard_regex = re.compile(r'^[0-9a-f]{2}$')
+        self._hash_regex = re.compile(r'^[0-9a-f]{30,62}(-[0-9a-z]+)?$')
+        self._max_size = opts.local_max_size()
+        self._max_count = opts.local_max_count()
+        self._totals = None
+        if not opts.no_local_stats():
+            self._totals = ClangTidyLocalCacheTotals(log, opts, self._scan_totals)
+
+    # --------------------------------------------------------------------------
+    def _is_bounded(self) -> bool:
+        return self._max_size > 0 or self._max_count > 0
 
     # --------------------------------------------------------------------------
     def is_cached(self, digest):
         path = self._make_path(digest)
         if os.path.isfile(path):
             os.utime(path, None)
+            if self._is_bounded():
+                self._index_append(digest, os.path.getsize(path))
             return True
 
         return False
@@ -760,7 +1686,10 @@ class ClangTidyLocalCache:
         if os.path.isfile(path):
             os.utime(path, None)
             with open(path, "rb") as stream:
-                return stream.read()
+                data = stream.read()
+            if self._is_bounded():
+                self._index_append(digest, len(data))
+            return data
         else:
             return None
 
@@ -768,26 +1697,273 @@ class ClangTidyLocalCache:
     def store_in_cache(self, digest):
         p = self._make_path(digest)
         mkdir_p(os.path.dirname(p))
+        old_size = self._entry_size(p)
         open(p, "w").close()
+        self._stored(digest, 0, old_size)
 
     # --------------------------------------------------------------------------
     def store_in_cache_with_data(self, digest, data: bytes):
         p = self._make_path(digest)
         mkdir_p(os.path.dirname(p))
+        old_size = self._entry_size(p)
         with open(p, "wb") as stream:
             stream.write(data)
+        self._stored(digest, len(data), old_size)
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _entry_size(path) -> Optional[int]:
+        "Returns the size of an existing entry, None if it does not exist."
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    # --------------------------------------------------------------------------
+    def _index_path(self, shard: str) -> os.PathLike:
+        return os.path.join(self._opts.cache_dir, shard, self._index_name)
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _lock(stream, flags) -> bool:
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        try:
+            fcntl.flock(stream, flags(fcntl))
+            return True
+        except OSError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def _index_append(self, digest, size: int) -> Optional[int]:
+        """
+        Records the size and the access time of an entry in the shard index.
+        Returns the size of the index, None if it could not be updated.
+        """
+        record = f"{digest[2:]} {size} {int(time.time())}\n".encode("utf8")
+        try:
+            with open(self._index_path(digest[:2]), "ab") as index:
+                # the shared lock keeps the records out of a concurrent trim
+                self._lock(index, lambda fcntl: fcntl.LOCK_SH)
+                index.write(record)
+                return index.tell()
+        except OSError as error:
+            self._log.debug(f"Failed to update the local cache index: {error}")
+            return None
+
+    # --------------------------------------------------------------------------
+    def _update_shard_totals(self, shard: str, update) -> Optional[List[int]]:
+        """
+        Applies the update to the entry count, total size and compacted index
+        size of the shard and returns the result, None if they are unknown.
+        """
+        path = os.path.join(self._opts.cache_dir, shard, self._totals_name)
+        try:
+            with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+") as f:
+                self._lock(f, lambda fcntl: fcntl.LOCK_EX)
+                try:
+                    totals = [int(x) for x in f.read().split()]
+                    if len(totals) != 3:
+                        totals = None
+                except ValueError:
+                    totals = None
+                totals = update(totals)
+                if totals is not None:
+                    f.seek(0)
+                    f.truncate()
+                    f.write("%d %d %d\n" % tuple(totals))
+                return totals
+        except OSError as error:
+            self._log.debug(f"Failed to update the local cache shard totals: {error}")
+            return None
+
+    # --------------------------------------------------------------------------
+    def _stored(self, digest, size: int, old_size: Optional[int]) -> None:
+        if self._totals:
+            if old_size is None:
+                self._totals.add(1, size)
+            elif old_size != size:
+                self._totals.add(0, size - old_size)
+        if self._is_bounded():
+            shard = digest[:2]
+            # a shard without an index was populated without the limits
+            reconcile = not os.path.isfile(self._index_path(shard))
+            index_size = self._index_append(digest, size)
+
+            def _add(totals):
+                if totals is None:
+                    return None
+                count, total_size, compacted_size = totals
+                if old_size is None:
+                    return [count + 1, total_size + size, compacted_size]
+                return [count, total_size + size - old_size, compacted_size]
+
+            totals = self._update_shard_totals(shard, _add)
+            if reconcile or totals is None or index_size is None or \
+                    self._shard_needs_trim(totals, index_size):
+                self.trim_shard(shard, reconcile, wait=False)
+
+    # --------------------------------------------------------------------------
+    def _shard_needs_trim(self, totals: List[int], index_size: int) -> bool:
+        "Checks if the shard may exceed its limits or its index needs compaction."
+        count, size, compacted_size = totals
+        max_size, max_count = self._shard_limits()
+        return (max_size > 0 and size > max_size) or \
+            (max_count > 0 and count > max_count) or \
+            index_size > 2 * compacted_size + 4096
+
+    # --------------------------------------------------------------------------
+    def _shard_limits(self) -> Tuple[int, int]:
+        "Returns the size and count limits of a single shard (0 = unlimited)."
+        def _share(limit):
+            return max(1, (limit + 255) // 256) if limit > 0 else 0
+        return _share(self._max_size), _share(self._max_count)
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _parse_index(content: bytes) -> dict:
+        "Returns the last recorded [size, access time] of each indexed entry."
+        entries = {}
+        for line in content.decode("utf8", "replace").splitlines():
+            try:
+                name, size, atime = line.split()
+                entries[name] = [int(size), int(atime)]
+            except ValueError:
+                pass
+        return entries
+
+    # --------------------------------------------------------------------------
+    def _scan_shard(self, shard_dir, entries: dict) -> dict:
+        "Adds the unindexed entries and drops the entries which no longer exist."
+        found = {}
+        try:
+            for entry in os.scandir(shard_dir):
+                if self._hash_regex.match(entry.name):
+                    if entry.name in entries:
+                        found[entry.name] = entries[entry.name]
+                        continue
+                    try:
+                        st = entry.stat()
+                        found[entry.name] = [st.st_size, int(st.st_atime)]
+                    except OSError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return found
+
+    # --------------------------------------------------------------------------
+    def trim_shard(self, shard: str, reconcile=False, wait=True) -> int:
+        """
+        Evicts the least recently used entries from the shard until it fits
+        into its share of the limits and compacts the shard index.
+        Returns the number of evicted entries.
+        """
+        shard_dir = os.path.join(self._opts.cache_dir, shard)
+        max_size, max_count = self._shard_limits()
+        try:
+            index = os.fdopen(os.open(self._index_path(shard), os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        except OSError:
+            return 0
+
+        with index:
+            if not self._lock(index, lambda fcntl: fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB)):
+                # another process is trimming this shard right now
+                return 0
+            content = index.read()
+            entries = self._parse_index(content)
+            if reconcile or not content:
+                entries = self._scan_shard(shard_dir, entries)
+
+            count = len(entries)
+            size = sum(e[0] for e in entries.values())
+            evicted = 0
+            evicted_size = 0
+            for name, (entry_size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+                if (max_size <= 0 or size <= max_size) and (max_count <= 0 or count <= max_count):
+                    break
+                try:
+                    os.unlink(os.path.join(shard_dir, name))
+                    evicted += 1
+                    evicted_size += entry_size
+                except FileNotFoundError:
+                    pass
+                except OSError as error:
+                    self._log.debug(f"Failed to evict {name}: {error}")
+                    continue
+                del entries[name]
+                count -= 1
+                size -= entry_size
+
+            compacted_size = len(content)
+            if evicted or reconcile or content.count(b"\n") > 2 * len(entries) + 16:
+                compacted = "".join(
+                    f"{name} {entry_size} {atime}\n"
+                    for name, (entry_size, atime) in entries.items()).encode("utf8")
+                index.seek(0)
+                index.truncate()
+                index.write(compacted)
+                compacted_size = len(compacted)
+            # the exact totals replace the ones maintained by the stores
+            self._update_shard_totals(shard, lambda _: [count, size, compacted_size])
+        if evicted:
+            if self._totals:
+                self._totals.add(-evicted, -evicted_size)
+            self._log.debug(f"Evicted {evicted} entries from the local cache shard {shard}")
+        return evicted
+
+    # --------------------------------------------------------------------------
+    def trim(self) -> int:
+        "Trims all shards of the cache, returns the number of evicted entries."
+        if not self._is_bounded():
+            self._log.warning("The local cache size is not limited, nothing to trim")
+            return 0
+        evicted = 0
+        for i in range(0, 256):
+            shard = f'{i:02x}'
+            if os.path.isdir(os.path.join(self._opts.cache_dir, shard)):
+                evicted += self.trim_shard(shard, reconcile=True)
+        return evicted
+
+    # --------------------------------------------------------------------------
+    def compact(self) -> None:
+        self._log.warning("The file-based local cache does not need compaction")
 
     # --------------------------------------------------------------------------
     def _list_cached_files(self, options, base_dir):
         for root, dirs, files in os.walk(base_dir):
+            if root != base_dir and not self._shard_regex.match(os.path.basename(root)):
+                dirs.clear()
+                continue
             for filename in files:
                 if self._hash_regex.match(filename):
                     yield root, filename
 
+    # --------------------------------------------------------------------------
+    def _scan_totals(self) -> Tuple[int, int]:
+        count, size = 0, 0
+        for root, filename in self._list_cached_files(self._opts, self._opts.cache_dir):
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+                count += 1
+            except OSError:
+                pass
+        return count, size
+
+    # --------------------------------------------------------------------------
+    def reconcile_stats(self) -> None:
+        "Recomputes the maintained entry count and size with a full scan."
+        if self._totals:
+            self._totals.reconcile()
+
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
-        hash_count = sum(1 for x in self._list_cached_files(options, options.cache_dir))
-        return {"cached_count": hash_count}
+        if self._totals:
+            hash_count, size = self._totals.read()
+        else:
+            hash_count, size = self._scan_totals()
+        return {"cached_count": hash_count, "cached_size_bytes": size}
 
     # --------------------------------------------------------------------------
     def clear_stats(self, options):
@@ -797,12 +1973,239 @@ class ClangTidyLocalCache:
     def _make_path(self, digest):
         return os.path.join(self._opts.cache_dir, digest[:2], digest[2:])
 
+# ------------------------------------------------------------------------------
+class ClangTidyLocalDbCache:
+    """
+    Local cache storing all entries in a single SQLite database instead of
+    one file per entry, which saves inodes and makes cleaning, backups and
+    statistics cheap. The database is shared by the parallel build jobs
+    (WAL journal, writes in immediate transactions). The entry count and total
+    size are maintained by triggers, the size and count limits are enforced
+    on each store by evicting the least recently used entries.
+    """
+    stats_name = "local"
+    # the access times are refreshed at most this often, to avoid writes on hits
+    _atime_resolution = 3600
+    _batch_size = 500
+    # stored in PRAGMA user_version once the schema below is created
+    _schema_version = 1
+    _schema = """
+        CREATE TABLE IF NOT EXISTS entries (
+            digest TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            atime INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS entries_atime ON entries(atime);
+        CREATE TABLE IF NOT EXISTS totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            count INTEGER NOT NULL,
+            size INTEGER NOT NULL);
+        INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+        CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+            UPDATE totals SET count = count + 1, size = size + new.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+            UPDATE totals SET count = count - 1, size = size - old.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+            UPDATE totals SET size = size - old.size + new.size;
+        END;
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._max_size = opts.local_max_size()
+        self._max_count = opts.local_max_count()
+        self._db = None
+        self._pid = None
+
+    # --------------------------------------------------------------------------
+    def _connection(self):
+        # connections must not be shared with the processes forked by the worker
+        if self._db is None or self._pid != os.getpid():
+            import sqlite3
+
+            mkdir_p(self._opts.cache_dir)
+            self._db = sqlite3.connect(
+                self._opts.local_db_path(), timeout=60, isolation_level=None)
+            self._pid = os.getpid()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("PRAGMA journal_size_limit=%d" % (16 * 1024 * 1024))
+            self._create_schema(self._db)
+        return self._db
+
+    # --------------------------------------------------------------------------
+    def _create_schema(self, db) -> None:
+        "Creates the schema, if necessary, without locking existing databases."
+        if db.execute("PRAGMA user_version").fetchone()[0] >= self._schema_version:
+            return
+        try:
+            db.executescript(
+                "BEGIN IMMEDIATE;%sPRAGMA user_version=%d;COMMIT;" % (
+                    self._schema, self._schema_version))
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+
+    # --------------------------------------------------------------------------
+    def _touch(self, db, rows) -> None:
+        "Refreshes the access times of the found entries if they are stale."
+        now = int(time.time())
+        stale = [(now, digest) for digest, atime in rows if now - atime > self._atime_resolution]
+        if stale:
+            db.executemany("UPDATE entries SET atime = ? WHERE digest = ?", stale)
+
+    # --------------------------------------------------------------------------
+    def is_cached(self, digest) -> bool:
+        db = self._connection()
+        rows = db.execute(
+            "SELECT digest, atime FROM entries WHERE digest = ?", (digest,)).fetchall()
+        self._touch(db, rows)
+        return bool(rows)
+
+    # --------------------------------------------------------------------------
+    def get_cache_data(self, digest) -> Optional[bytes]:
+        db = self._connection()
+        row = db.execute(
+            "SELECT atime, data FROM entries WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self._touch(db, [(digest, row[0])])
+        return bytes(row[1])
+
+    # --------------------------------------------------------------------------
+    def _select_many(self, digests: List[str], columns: str):
+        db = self._connection()
+        for i in range(0, len(digests), self._batch_size):
+            batch = digests[i:i + self._batch_size]
+            rows = db.execute(
+                "SELECT digest, atime%s FROM entries WHERE digest IN (%s)" % (
+                    columns, ",".join("?" * len(batch))), batch).fetchall()
+            self._touch(db, [row[:2] for row in rows])
+            yield from rows
+
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        result = {digest: False for digest in digests}
+        for row in self._select_many(digests, ""):
+            result[row[0]] = True
+        return result
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        result = {digest: None for digest in digests}
+        for row in self._select_many(digests, ", data"):
+            result[row[0]] = bytes(row[2])
+        return result
+
+    # --------------------------------------------------------------------------
+    def store_in_cache(self, digest):
+        self.store_in_cache_with_data_many({digest: bytes()})
+
+    # --------------------------------------------------------------------------
+    def store_in_cache_with_data(self, digest, data: bytes):
+        self.store_in_cache_with_data_many({digest: data})
+
+    # --------------------------------------------------------------------------
+    def store_in_cache_with_data_many(self, items: dict) -> None:
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # the time is read only after the lock is held, so that the stored
+            # rows are not older than the ones committed while waiting for it
+            now = int(time.time())
+            db.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?) ON CONFLICT(digest) DO UPDATE "
+                "SET data = excluded.data, size = excluded.size, atime = excluded.atime",
+                [(digest, data or bytes(), len(data or bytes()), now) for digest, data in items.items()])
+            self._evict(db, list(items))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    # --------------------------------------------------------------------------
+    def _evict(self, db, keep: Optional[List[str]] = None) -> int:
+        """
+        Evicts the least recently used entries exceeding the limits,
+        except for the specified (just stored) ones.
+        """
+        keep = (keep or [])[:self._batch_size]
+        exclude = "WHERE digest NOT IN (%s) " % ",".join("?" * len(keep)) if keep else ""
+        evicted = 0
+        while True:
+            count, size = db.execute("SELECT count, size FROM totals").fetchone()
+            excess = 0
+            if self._max_count > 0 and count > self._max_count:
+                excess = count - self._max_count
+            if self._max_size > 0 and size > self._max_size:
+                excess = max(excess, 1 + count * (size - self._max_size) // size // 2)
+            if excess <= 0:
+                return evicted
+            deleted = db.execute(
+                "DELETE FROM entries WHERE digest IN "
+                "(SELECT digest FROM entries %sORDER BY atime, rowid LIMIT ?)" % exclude,
+                keep + [excess]).rowcount
+            if deleted <= 0:
+                return evicted
+            evicted += deleted
+
+    # --------------------------------------------------------------------------
+    def trim(self) -> int:
+        "Evicts the entries exceeding the limits, returns their number."
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            evicted = self._evict(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return evicted
+
+    # --------------------------------------------------------------------------
+    def compact(self) -> None:
+        "Reclaims the space of the evicted entries and truncates the journal."
+        db = self._connection()
+        db.execute("VACUUM")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # --------------------------------------------------------------------------
+    def reconcile_stats(self) -> None:
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute(
+            "UPDATE totals SET (count, size) = "
+            "(SELECT count(*), coalesce(sum(size), 0) FROM entries)")
+        db.execute("COMMIT")
+
+    # --------------------------------------------------------------------------
+    def query_stats(self, options) -> dict:
+        count, size = self._connection().execute("SELECT count, size FROM totals").fetchone()
+        return {"cached_count": count, "cached_size_bytes": size}
+
+    # --------------------------------------------------------------------------
+    def clear_stats(self, options):
+        pass
+
+# ------------------------------------------------------------------------------
+def make_local_cache(log, opts):
+    "Returns the local cache backend selected by CTCACHE_LOCAL_BACKEND."
+    if opts.local_backend() == "sqlite":
+        return ClangTidyLocalDbCache(log, opts)
+    return ClangTidyLocalCache(log, opts)
+
 # ------------------------------------------------------------------------------
 class ClangTidyRedisCache:
+    stats_name = "redis"
     # --------------------------------------------------------------------------
     def __init__(self, log, opts: ClangTidyCacheOpts):
         self._log = log
         self._opts = opts
+        redis = import_redis()
         assert redis
         self._cli = redis.Redis(
             host=opts.redis_host(),
@@ -818,26 +2221,65 @@ class ClangTidyRedisCache:
             lib_name=None,
             lib_version=None)
         self._namespace = opts.redis_namespace()
+        # the optimized mode additionally uses the EXISTS, GETEX and MGET
+        # commands and pipelining to minimize the number of round-trips
+        self._optimized = opts.redis_optimized()
 
     # --------------------------------------------------------------------------
     def _get_key_from_digest(self, digest) -> str:
         return self._namespace + digest
 
+    # --------------------------------------------------------------------------
+    def _extended_ttl(self) -> Optional[int]:
+        "Returns the TTL to set on cache hits or None if it should not be extended."
+        if self._opts.redis_read_only():
+            return None
+        return self._opts.redis_cache_ttl()
+
     # --------------------------------------------------------------------------
     def is_cached(self, digest) -> bool:
         n_digest = self._get_key_from_digest(digest)
+        if self._optimized:
+            return self._cli.exists(n_digest) > 0
         return self._cli.get(n_digest) is not None
 
     # --------------------------------------------------------------------------
     def get_cache_data(self, digest) -> Optional[bytes]:
         n_digest = self._get_key_from_digest(digest)
+        ttl = self._extended_ttl()
+        if self._optimized and ttl is not None:
+            # read and extend TTL in a single command
+            return self._cli.getex(n_digest, ex=ttl)
         data = self._cli.get(n_digest)
-        ttl = self._opts.redis_cache_ttl()
-        if not self._opts.redis_read_only() and data is not None and ttl is not None:
+        if data is not None and ttl is not None:
             # try to extend TTL on cache hits
             self._cli.expire(n_digest, ttl, xx=True)
         return data
 
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        if not self._optimized:
+            return {digest: self.is_cached(digest) for digest in digests}
+        pipe = self._cli.pipeline(transaction=False)
+        for digest in digests:
+            pipe.exists(self._get_key_from_digest(digest))
+        return {digest: found > 0 for digest, found in zip(digests, pipe.execute())}
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        if not self._optimized:
+            return {digest: self.get_cache_data(digest) for digest in digests}
+        if not digests:
+            return {}
+        n_digests = [self._get_key_from_digest(digest) for digest in digests]
+        ttl = self._extended_ttl()
+        if ttl is None:
+            return dict(zip(digests, self._cli.mget(n_digests)))
+        pipe = self._cli.pipeline(transaction=False)
+        for n_digest in n_digests:
+            pipe.getex(n_digest, ex=ttl)
+        return dict(zip(digests, pipe.execute()))
+
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
         self.store_in_cache_with_data(digest, bytes())
@@ -849,6 +2291,20 @@ class ClangTidyRedisCache:
         n_digest = self._get_key_from_digest(digest)
         self._cli.set(n_digest, data, ex=self._opts.redis_cache_ttl())
 
+    # --------------------------------------------------------------------------
+    def store_in_cache_with_data_many(self, items: dict):
+        "Stores the data of multiple digests (pipelined in the optimized mode)."
+        if self._opts.redis_read_only():
+            return
+        if not self._optimized:
+            for digest, data in items.items():
+                self.store_in_cache_with_data(digest, data)
+            return
+        pipe = self._cli.pipeline(transaction=False)
+        for digest, data in items.items():
+            pipe.set(self._get_key_from_digest(digest), data, ex=self._opts.redis_cache_ttl())
+        pipe.execute()
+
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
         # TODO
@@ -861,41 +2317,102 @@ class ClangTidyRedisCache:
 
 # ------------------------------------------------------------------------------
 class ClangTidyS3Cache:
+    stats_name = "s3"
+    # The S3 clients shared by all instances in the process, keyed by their settings
+    _clients = {}
+    # Object metadata key and value marking compressed cached outputs
+    _encoding_key = "ctcache-encoding"
+    _zlib_encoding = "zlib"
+
     # --------------------------------------------------------------------------
     def __init__(self, log, opts):
-        from boto3 import client
         from botocore.exceptions import ClientError
-        from botocore.config import Config
-        from botocore.session import UNSIGNED
 
         self._ClientError = ClientError
         self._log = log
         self._opts = opts
-        if self._opts.s3_no_credentials():
-            self._client = client("s3", config=Config(signature_version=UNSIGNED))
-        else:
-            self._client = client("s3")
+        self._client = self._get_client(opts)
         self._bucket = opts.s3_bucket()
         self._bucket_folder = opts.s3_bucket_folder()
 
+    # --------------------------------------------------------------------------
+    @classmethod
+    def _get_client(cls, opts):
+        from boto3 import client
+        from botocore.config import Config
+        from botocore.session import UNSIGNED
+
+        settings = (bool(opts.s3_no_credentials()), opts.s3_endpoint_url(), opts.s3_pool_size())
+        try:
+            return cls._clients[settings]
+        except KeyError:
+            pass
+
+        config = Config(
+            max_pool_connections=opts.s3_pool_size(),
+            retries={"max_attempts": 3, "mode": "standard"})
+        if opts.s3_no_credentials():
+            config = config.merge(Config(signature_version=UNSIGNED))
+        s3_client = client("s3", endpoint_url=opts.s3_endpoint_url(), config=config)
+        cls._clients[settings] = s3_client
+        return s3_client
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _is_not_found(error) -> bool:
+        return error.response['Error']['Code'] in ["404", "NoSuchKey", "NotFound"]
+
     # --------------------------------------------------------------------------
     def is_cached(self, digest) -> bool:
         try:
             path = self._make_path(digest)
-            self._client.get_object(Bucket=self._bucket, Key=path)
+            self._client.head_object(Bucket=self._bucket, Key=path)
         except self._ClientError as e:
-            if e.response['Error']['Code'] == "NoSuchKey":
+            if self._is_not_found(e):
                 return False
 
-            self._log.error("Error calling S3:get_object %s", str(e))
+            self._log.error("Error calling S3:head_object %s", str(e))
             raise
 
         return True
 
     # --------------------------------------------------------------------------
     def get_cache_data(self, digest) -> Optional[bytes]:
-        # TODO
-        return None
+        try:
+            path = self._make_path(digest)
+            response = self._client.get_object(Bucket=self._bucket, Key=path)
+            data = response["Body"].read()
+        except self._ClientError as e:
+            if self._is_not_found(e):
+                return None
+
+            self._log.error("Error calling S3:get_object %s", str(e))
+            raise
+
+        if response.get("Metadata", {}).get(self._encoding_key) == self._zlib_encoding:
+            import zlib
+            data = zlib.decompress(data)
+        return data
+
+    # --------------------------------------------------------------------------
+    def _lookup_many(self, lookup, digests: List[str]) -> dict:
+        # S3 has no multi-object reads, but the client is thread-safe and
+        # the individual requests are sent concurrently over the pooled connections
+        from concurrent.futures import ThreadPoolExecutor
+
+        if len(digests) < 2:
+            return {digest: lookup(digest) for digest in digests}
+        workers = max(1, min(len(digests), self._opts.s3_pool_size()))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(digests, executor.map(lookup, digests)))
+
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        return self._lookup_many(self.is_cached, digests)
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        return self._lookup_many(self.get_cache_data, digests)
 
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
@@ -910,8 +2427,25 @@ class ClangTidyS3Cache:
 
     # --------------------------------------------------------------------------
     def store_in_cache_with_data(self, digest, data: bytes):
-        # TODO
-        pass
+        if self._opts.s3_no_credentials() or self._opts.s3_read_only():
+            return
+        metadata = {}
+        # the outputs compressed by the codec would not shrink any further
+        if self._opts.s3_compress() and not data.startswith(OUTPUT_MAGIC):
+            import zlib
+            data = zlib.compress(data)
+            metadata[self._encoding_key] = self._zlib_encoding
+        try:
+            path = self._make_path(digest)
+            self._client.put_object(
+                Bucket=self._bucket,
+                Key=path,
+                Body=data,
+                ContentType="application/octet-stream",
+                Metadata=metadata)
+        except self._ClientError as e:
+            self._log.error("Error calling S3:put_object {}".format(str(e)))
+            raise
 
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
@@ -929,6 +2463,7 @@ class ClangTidyS3Cache:
 
 # ------------------------------------------------------------------------------
 class ClangTidyGcsCache:
+    stats_name = "gcs"
     # --------------------------------------------------------------------------
     def __init__(self, log, opts):
         import google.cloud.storage as gcs
@@ -1003,29 +2538,157 @@ class ClangTidyGcsCache:
         return os.path.join(self._bucket_folder, digest[:2], digest[2:])
 
 # ------------------------------------------------------------------------------
-class ClangTidyMultiCache:
-    # --------------------------------------------------------------------------
-    def __init__(self, log, caches):
-        self._log = log
-        self._caches = caches
+def is_cached_many(cache, digests: List[str]) -> dict:
+    """
+    Returns a dictionary indicating which of the digests are cached.
+    Uses the bulk lookup of the cache if it implements one.
+    """
+    lookup = getattr(cache, "is_cached_many", None)
+    if lookup is not None:
+        return lookup(digests)
+    return {digest: cache.is_cached(digest) for digest in digests}
+
+# ------------------------------------------------------------------------------
+def get_cache_data_many(cache, digests: List[str]) -> dict:
+    """
+    Returns a dictionary with the cached data (or None) for each digest.
+    Uses the bulk lookup of the cache if it implements one.
+    """
+    lookup = getattr(cache, "get_cache_data_many", None)
+    if lookup is not None:
+        return lookup(digests)
+    return {digest: cache.get_cache_data(digest) for digest in digests}
+
+# ------------------------------------------------------------------------------
+def store_in_cache_with_data_many(cache, items: dict) -> None:
+    """
+    Stores the data of multiple digests in the cache.
+    Uses the bulk store of the cache if it implements one.
+    """
+    store = getattr(cache, "store_in_cache_with_data_many", None)
+    if store is not None:
+        store(items)
+        return
+    for digest, data in items.items():
+        cache.store_in_cache_with_data(digest, data)
+
+# ------------------------------------------------------------------------------
+class ClangTidyMultiCache:
+    # the number of the hit sources kept if they are not consumed
+    _max_hit_sources = 1024
+    # --------------------------------------------------------------------------
+    def __init__(self, log, caches, parallel_timeout: Optional[float] = None):
+        self._log = log
+        self._caches = caches
+        # if set, single lookups query all caches concurrently
+        self._parallel_timeout = parallel_timeout
+        # the names of the caches which served the hits, until they are popped
+        # by the statistics (the oldest are dropped if nobody pops them)
+        self.hit_sources = {}
+
+    # --------------------------------------------------------------------------
+    def _record_hit(self, digest, cache) -> None:
+        self.hit_sources.pop(digest, None)
+        self.hit_sources[digest] = getattr(cache, "stats_name", None)
+        if len(self.hit_sources) > self._max_hit_sources:
+            del self.hit_sources[next(iter(self.hit_sources))]
+
+    # --------------------------------------------------------------------------
+    def _race(self, digest, lookup, is_hit):
+        """
+        Runs the lookup in all caches concurrently and returns the first
+        result which is a hit, or None if all caches missed or timed out.
+        Failing caches count as misses and the results of the slower caches
+        are ignored; their threads are daemonic, so they do not delay the exit.
+        """
+        import queue
+        import threading
+
+        results = queue.Queue()
+
+        def _lookup(cache):
+            try:
+                results.put((cache, lookup(cache)))
+            except Exception as error:
+                self._log.debug(f"Parallel lookup failed: {error}")
+                results.put((cache, None))
+
+        for cache in self._caches:
+            threading.Thread(target=_lookup, args=(cache,), daemon=True).start()
+
+        deadline = time.monotonic() + self._parallel_timeout
+        for _ in self._caches:
+            try:
+                cache, result = results.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                self._log.debug("Parallel lookup timed out")
+                break
+            if is_hit(result):
+                self._record_hit(digest, cache)
+                return result
+
+        return None
+
+    # --------------------------------------------------------------------------
+    def _is_parallel(self) -> bool:
+        return self._parallel_timeout is not None and len(self._caches) > 1
 
     # --------------------------------------------------------------------------
     def is_cached(self, digest) -> bool:
+        if self._is_parallel():
+            return bool(self._race(digest, lambda c: c.is_cached(digest), lambda r: r))
+
         for cache in self._caches:
             if cache.is_cached(digest):
+                self._record_hit(digest, cache)
                 return True
 
         return False
 
     # --------------------------------------------------------------------------
     def get_cache_data(self, digest) -> Optional[bytes]:
+        if self._is_parallel():
+            return self._race(
+                digest, lambda c: c.get_cache_data(digest), lambda r: r is not None)
+
         for cache in self._caches:
             data = cache.get_cache_data(digest)
             if data is not None:
+                self._record_hit(digest, cache)
                 return data
 
         return None
 
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        result = {digest: False for digest in digests}
+        pending = list(digests)
+        for cache in self._caches:
+            if not pending:
+                break
+            found = is_cached_many(cache, pending)
+            for digest in pending:
+                if found.get(digest):
+                    result[digest] = True
+                    self._record_hit(digest, cache)
+            pending = [digest for digest in pending if not result[digest]]
+        return result
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        result = {digest: None for digest in digests}
+        pending = list(digests)
+        for cache in self._caches:
+            if not pending:
+                break
+            found = get_cache_data_many(cache, pending)
+            for digest in pending:
+                if found.get(digest) is not None:
+                    result[digest] = found[digest]
+                    self._record_hit(digest, cache)
+            pending = [digest for digest in pending if result[digest] is None]
+        return result
+
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
         for cache in self._caches:
@@ -1036,6 +2699,11 @@ class ClangTidyMultiCache:
         for cache in self._caches:
             cache.store_in_cache_with_data(digest, data)
 
+    # --------------------------------------------------------------------------
+    def store_in_cache_with_data_many(self, items: dict):
+        for cache in self._caches:
+            store_in_cache_with_data_many(cache, items)
+
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
         for cache in self._caches:
@@ -1059,20 +2727,46 @@ class ClangTidyCacheWithStats:
         self._cache = cache
         self._stats = stats
 
+    # --------------------------------------------------------------------------
+    def _update(self, digest, hit) -> None:
+        if self._stats:
+            backend = None
+            if hit:
+                backend = getattr(self._cache, "hit_sources", {}).pop(digest, None) or \
+                    getattr(self._cache, "stats_name", None)
+            self._stats.update(digest, hit, backend)
+
     # --------------------------------------------------------------------------
     def is_cached(self, digest) -> bool:
         res = self._cache.is_cached(digest)
-        if self._stats:
-            self._stats.update(digest, res)
+        self._update(digest, res)
         return res
 
     # --------------------------------------------------------------------------
     def get_cache_data(self, digest) -> Optional[bytes]:
         res = self._cache.get_cache_data(digest)
-        if self._stats:
-            self._stats.update(digest, res is not None)
+        self._update(digest, res is not None)
+        return res
+
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        res = is_cached_many(self._cache, digests)
+        for digest in digests:
+            self._update(digest, res[digest])
+        return res
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        res = get_cache_data_many(self._cache, digests)
+        for digest in digests:
+            self._update(digest, res[digest] is not None)
         return res
 
+    # --------------------------------------------------------------------------
+    def record_run(self, seconds: float):
+        if self._stats:
+            self._stats.record_run(seconds)
+
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
         self._cache.store_in_cache(digest)
@@ -1081,6 +2775,10 @@ class ClangTidyCacheWithStats:
     def store_in_cache_with_data(self, digest, data: bytes):
         self._cache.store_in_cache_with_data(digest, data)
 
+    # --------------------------------------------------------------------------
+    def store_in_cache_with_data_many(self, items: dict):
+        store_in_cache_with_data_many(self._cache, items)
+
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
         stats = self._cache.query_stats(options)
@@ -1088,12 +2786,18 @@ class ClangTidyCacheWithStats:
             stats = {}
 
         if self._stats:
-            hits, misses = self._stats.read()
+            summary = self._stats.summary()
+            hits, misses = summary["hits"], summary["misses"]
             total = hits + misses
             stats["hit_count"] = hits
             stats["miss_count"] = misses
             stats["hit_rate"] = hits/total if total else 0
             stats["miss_rate"] = misses/total if total else 0
+            stats["backend_hit_count"] = summary["backend_hits"]
+            stats["run_count"] = summary["runs"]
+            stats["run_seconds"] = summary["run_seconds"]
+            average_run = summary["run_seconds"] / summary["runs"] if summary["runs"] else 0
+            stats["time_saved_seconds"] = hits * average_run
 
         return stats
 
@@ -1103,6 +2807,213 @@ class ClangTidyCacheWithStats:
         if self._stats:
             self._stats.clear()
 
+# ------------------------------------------------------------------------------
+class ClangTidyWriteBehindSpool:
+    """
+    Directory of pending remote stores used in the write-behind mode.
+    Each entry is a file named `<digest>.<attempts>.<kind>`, where the kind
+    is `d` for stores with data (which is the file content) or `h` for stores
+    of the hash only. The entries are uploaded by a detached
+    `clang-tidy-cache --upload-spool` process, at most one of which drains
+    the spool at any time (guarded by an flock on the `.lock` file).
+    The total size of the entries is kept in the `.size` file (updated under
+    an flock on it), so that enqueuing does not need to scan the spool.
+    """
+    _lock_name = ".lock"
+    _size_name = ".size"
+    _batch_size = 100
+
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._dir = opts.spool_dir()
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def supported() -> bool:
+        try:
+            import fcntl
+            return True
+        except ImportError:
+            return False
+
+    # --------------------------------------------------------------------------
+    def _entries(self) -> List[os.DirEntry]:
+        try:
+            return [e for e in os.scandir(self._dir) if not e.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _entry_size(entry: os.DirEntry) -> int:
+        try:
+            return entry.stat().st_size
+        except OSError:
+            return 0
+
+    # --------------------------------------------------------------------------
+    def _update_size(self, update) -> bool:
+        """
+        Replaces the recorded size of the spool with the result of the update
+        function, unless it returns None. Returns if the size was replaced.
+        """
+        import fcntl
+
+        mkdir_p(self._dir)
+        path = os.path.join(self._dir, self._size_name)
+        with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                size = max(0, int(f.read() or 0))
+            except ValueError:
+                size = 0
+            size = update(size)
+            if size is None:
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write(str(max(0, size)))
+            return True
+
+    # --------------------------------------------------------------------------
+    def enqueue(self, digest, data: Optional[bytes]) -> bool:
+        "Adds a pending store to the spool, returns False if it is full."
+        size = len(data) if data is not None else 0
+        limit = self._opts.spool_max_size()
+        try:
+            if not self._update_size(lambda total: total + size if total + size <= limit else None):
+                self._log.debug("Write-behind spool is full")
+                return False
+        except OSError as error:
+            self._log.debug(f"Failed to update the spool size: {error}")
+            return False
+        kind = "h" if data is None else "d"
+        try:
+            write_file_atomic(os.path.join(self._dir, f"{digest}.0.{kind}"), data or bytes())
+        except OSError as error:
+            self._log.debug(f"Failed to spool {digest}: {error}")
+            self._release_size(size)
+            return False
+        return True
+
+    # --------------------------------------------------------------------------
+    def _release_size(self, size: int) -> None:
+        if size:
+            try:
+                self._update_size(lambda total: total - size)
+            except OSError:
+                pass
+
+    # --------------------------------------------------------------------------
+    def _try_lock(self):
+        "Returns the open lock file if the lock was acquired, None otherwise."
+        import fcntl
+
+        mkdir_p(self._dir)
+        lock = open(os.path.join(self._dir, self._lock_name), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except OSError:
+            lock.close()
+            return None
+
+    # --------------------------------------------------------------------------
+    def start_uploader(self) -> None:
+        "Starts a detached uploader unless one is already draining the spool."
+        import subprocess
+
+        lock = self._try_lock()
+        if lock is None:
+            # the running uploader rescans the spool after releasing the lock
+            return
+        lock.close()
+        subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), "--upload-spool"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True)
+
+    # --------------------------------------------------------------------------
+    def _retry_or_drop(self, entry: os.DirEntry) -> None:
+        digest, attempts, kind = entry.name.rsplit(".", 2)
+        attempts = int(attempts) + 1
+        try:
+            if attempts >= self._opts.spool_max_retries():
+                self._log.error(f"Dropping {digest} after {attempts} failed uploads")
+                size = self._entry_size(entry)
+                os.unlink(entry.path)
+                self._release_size(size)
+            else:
+                os.replace(entry.path, os.path.join(self._dir, f"{digest}.{attempts}.{kind}"))
+        except OSError:
+            pass
+
+    # --------------------------------------------------------------------------
+    def _upload(self, cache, entries: List[os.DirEntry]) -> bool:
+        items = {}
+        hashes = []
+        for entry in entries:
+            digest, _, kind = entry.name.rsplit(".", 2)
+            if kind == "d":
+                try:
+                    with open(entry.path, "rb") as f:
+                        items[digest] = f.read()
+                except FileNotFoundError:
+                    continue
+            else:
+                hashes.append(digest)
+        try:
+            if items:
+                store_in_cache_with_data_many(cache, items)
+            for digest in hashes:
+                cache.store_in_cache(digest)
+        except Exception as error:
+            self._log.error(f"Uploading spooled results failed: {error}")
+            for entry in entries:
+                self._retry_or_drop(entry)
+            return False
+        uploaded_size = 0
+        for entry in entries:
+            try:
+                size = self._entry_size(entry)
+                os.unlink(entry.path)
+                uploaded_size += size
+            except OSError:
+                pass
+        self._release_size(uploaded_size)
+        return True
+
+    # --------------------------------------------------------------------------
+    def drain(self, cache) -> None:
+        "Uploads the spooled entries to the given (remote) cache."
+        while True:
+            lock = self._try_lock()
+            if lock is None:
+                return
+            with lock:
+                failures = 0
+                while True:
+                    entries = sorted(self._entries(), key=lambda e: e.name)
+                    if not entries:
+                        # corrects the recorded size if it drifted (e.g. after a crash)
+                        try:
+                            self._update_size(lambda total: sum(
+                                self._entry_size(e) for e in self._entries()))
+                        except OSError:
+                            pass
+                        break
+                    for i in range(0, len(entries), self._batch_size):
+                        if not self._upload(cache, entries[i:i + self._batch_size]):
+                            failures += 1
+                            time.sleep(min(failures, 10))
+            # entries spooled while the lock was held are picked up here
+            if not self._entries():
+                return
+
 # ------------------------------------------------------------------------------
 class ClangTidyCache:
     # --------------------------------------------------------------------------
@@ -1110,29 +3021,46 @@ class ClangTidyCache:
         self._log = log
         self._opts = opts
         self._local = None
-        self._remote = None
+        self._remote_cache = None
+        self._spool = None
+        if opts.write_behind() and ClangTidyWriteBehindSpool.supported():
+            self._spool = ClangTidyWriteBehindSpool(log, opts)
 
-        caches = []
+        # The remote backend clients are constructed only when first used
+        self._remote_factories = []
 
         if opts.has_host():
-            caches.append(ClangTidyServerCache(log, opts))
+            self._remote_factories.append(ClangTidyServerCache)
 
-        if opts.has_redis_host() and redis:
-            caches.append(ClangTidyRedisCache(log, opts))
+        if opts.has_redis_host() and import_redis() is not None:
+            self._remote_factories.append(ClangTidyRedisCache)
 
         if opts.has_s3():
-            caches.append(ClangTidyS3Cache(log, opts))
+            self._remote_factories.append(ClangTidyS3Cache)
 
         if opts.has_gcs():
-            caches.append(ClangTidyGcsCache(log, opts))
+            self._remote_factories.append(ClangTidyGcsCache)
 
-        if not caches or opts.cache_locally():
-            local = ClangTidyLocalCache(log, opts)
+        if not self._remote_factories or opts.cache_locally():
+            local = make_local_cache(log, opts)
             self._local = self._wrap_with_stats(local, "stats")
 
-        if caches:
-            remote = ClangTidyMultiCache(log, caches)
-            self._remote = self._wrap_with_stats(remote, "remote_stats")
+    # --------------------------------------------------------------------------
+    @property
+    def _remote(self):
+        if self._remote_cache is None and self._remote_factories:
+            caches = [factory(self._log, self._opts) for factory in self._remote_factories]
+            parallel_timeout = None
+            if self._opts.parallel_lookup():
+                parallel_timeout = self._opts.parallel_lookup_timeout()
+            remote = ClangTidyMultiCache(self._log, caches, parallel_timeout)
+            self._remote_cache = self._wrap_with_stats(remote, "remote_stats")
+        return self._remote_cache
+
+    # --------------------------------------------------------------------------
+    def warm_up(self) -> None:
+        "Constructs the remote backend clients ahead of their first use."
+        _ = self._remote
 
     # --------------------------------------------------------------------------
     def _wrap_with_stats(self, cache, name):
@@ -1171,11 +3099,68 @@ class ClangTidyCache:
 
         return None
 
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, digests: List[str]) -> dict:
+        result = {digest: False for digest in digests}
+        pending = list(digests)
+
+        if self._local and pending:
+            found = is_cached_many(self._local, pending)
+            result.update(found)
+            pending = [digest for digest in pending if not found[digest]]
+
+        if self._remote and pending:
+            found = is_cached_many(self._remote, pending)
+            for digest in pending:
+                if found[digest]:
+                    result[digest] = True
+                    if self.should_writeback():
+                        self._local.store_in_cache(digest)
+
+        return result
+
+    # --------------------------------------------------------------------------
+    def get_cache_data_many(self, digests: List[str]) -> dict:
+        result = {digest: None for digest in digests}
+        pending = list(digests)
+
+        if self._local and pending:
+            result.update(get_cache_data_many(self._local, pending))
+            pending = [digest for digest in pending if result[digest] is None]
+
+        if self._remote and pending:
+            found = get_cache_data_many(self._remote, pending)
+            for digest in pending:
+                data = found[digest]
+                if data is not None:
+                    result[digest] = data
+                    if self.should_writeback():
+                        self._local.store_in_cache_with_data(digest, data)
+
+        return result
+
+    # --------------------------------------------------------------------------
+    def _spool_remote_store(self, digest, data: Optional[bytes]) -> bool:
+        "Hands the remote store to the write-behind uploader if enabled."
+        if self._spool is None or not self._remote_factories:
+            return False
+        spooled = self._spool.enqueue(digest, data)
+        try:
+            # also when the spool is full, the uploader drains it and
+            # corrects its recorded size
+            self._spool.start_uploader()
+        except OSError as error:
+            self._log.debug(f"Failed to start spool uploader: {error}")
+        return spooled
+
     # --------------------------------------------------------------------------
     def store_in_cache(self, digest):
         if self._local:
             self._local.store_in_cache(digest)
 
+        if self._spool_remote_store(digest, None):
+            return
+
         if self._remote:
             self._remote.store_in_cache(digest)
 
@@ -1184,9 +3169,31 @@ class ClangTidyCache:
         if self._local:
             self._local.store_in_cache_with_data(digest, data)
 
+        if self._spool_remote_store(digest, data):
+            return
+
         if self._remote:
             self._remote.store_in_cache_with_data(digest, data)
 
+    # --------------------------------------------------------------------------
+    def record_run(self, seconds: float) -> None:
+        "Records the duration of a clang-tidy run in the statistics."
+        for cache in [self._local, self._remote]:
+            record = getattr(cache, "record_run", None)
+            if record is not None:
+                record(seconds)
+
+    # --------------------------------------------------------------------------
+    def upload_spool(self) -> None:
+        "Uploads the results spooled in the write-behind mode to the remote caches."
+        if self._remote_factories:
+            caches = [factory(self._log, self._opts) for factory in self._remote_factories]
+            for cache in caches:
+                # the spool retries the uploads which failed
+                cache.strict_stores = True
+            remote = ClangTidyMultiCache(self._log, caches)
+            ClangTidyWriteBehindSpool(self._log, self._opts).drain(remote)
+
     # --------------------------------------------------------------------------
     def query_stats(self, options) -> dict:
         stats = {}
@@ -1211,6 +3218,554 @@ class ClangTidyCache:
     def should_writeback(self) -> bool:
         return self._local is not None and not self._opts.no_local_writeback()
 
+# ------------------------------------------------------------------------------
+# Framing of the compressed cached outputs: the magic, the ID of the dictionary
+# (its Adler-32 checksum, 0 if none was used) and the zlib stream.
+OUTPUT_MAGIC = b"\x89CTZ"
+OUTPUT_BASE64_PREFIX = b"CTZ64:"
+
+# ------------------------------------------------------------------------------
+class ClangTidyOutputCodec:
+    """
+    Compresses the cached outputs (the return code byte followed by the
+    clang-tidy stdout) if enabled by CTCACHE_COMPRESS_OUTPUT, optionally with
+    a preset dictionary of the frequent diagnostic lines. The dictionary is
+    read from the cache directory and, if a server is configured, refreshed
+    from the server periodically. The replaced dictionary is kept, so that
+    the outputs compressed with it can still be decoded after the switch.
+    Outputs stored uncompressed by the previous versions are decoded as they are.
+    """
+    _header = "<4sI"
+    _header_size = 8
+    # how often the dictionary (or its absence) is refreshed from the server
+    _dict_refresh = 24 * 3600
+
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._dicts = None
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _read(path) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # --------------------------------------------------------------------------
+    def _load_dicts(self) -> List[bytes]:
+        "Returns the current and the previous dictionary (empty if none)."
+        path = self._opts.output_dict_path()
+        old_path = path + ".old"
+        data = self._read(path)
+        if not self._opts.has_host() or (data is not None and \
+                time.time() - os.path.getmtime(path) < self._dict_refresh):
+            return [data or bytes(), self._read(old_path) or bytes()]
+
+        # an empty file marks that the server did not have a dictionary
+        fetched = ClangTidyServerCache(self._log, self._opts).fetch_output_dict()
+        try:
+            if fetched and fetched != data:
+                if data:
+                    write_file_atomic(old_path, data)
+                write_file_atomic(path, fetched)
+                return [fetched, data or bytes()]
+            # unchanged or unavailable, checked again after the refresh interval
+            write_file_atomic(path, data or bytes())
+        except OSError as error:
+            self._log.debug(f"Failed to save the output dictionary: {error}")
+        return [data or bytes(), self._read(old_path) or bytes()]
+
+    # --------------------------------------------------------------------------
+    def _dictionaries(self) -> List[bytes]:
+        if self._dicts is None:
+            try:
+                self._dicts = self._load_dicts()
+            except OSError as error:
+                self._log.debug(f"Failed to load the output dictionary: {error}")
+                self._dicts = [bytes(), bytes()]
+        return self._dicts
+
+    # --------------------------------------------------------------------------
+    def _dictionary(self) -> bytes:
+        return self._dictionaries()[0]
+
+    # --------------------------------------------------------------------------
+    def encode(self, data: bytes) -> bytes:
+        if not self._opts.compress_output():
+            return data
+        import struct
+        import zlib
+
+        zdict = self._dictionary()
+        if zdict:
+            compressor = zlib.compressobj(9, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(9)
+        header = struct.pack(self._header, OUTPUT_MAGIC, zlib.adler32(zdict) if zdict else 0)
+        return header + compressor.compress(data) + compressor.flush()
+
+    # --------------------------------------------------------------------------
+    def decode(self, data: bytes) -> Optional[bytes]:
+        "Returns the decoded output or None if it cannot be decoded."
+        if not data.startswith(OUTPUT_MAGIC) or len(data) < self._header_size:
+            return data
+        import struct
+        import zlib
+
+        _, dict_id = struct.unpack(self._header, data[:self._header_size])
+        zdict = bytes()
+        if dict_id:
+            for candidate in self._dictionaries():
+                if candidate and zlib.adler32(candidate) == dict_id:
+                    zdict = candidate
+                    break
+            else:
+                self._log.debug("The cached output was compressed with another dictionary")
+                return None
+        try:
+            if zdict:
+                decompressor = zlib.decompressobj(zdict=zdict)
+            else:
+                decompressor = zlib.decompressobj()
+            return decompressor.decompress(data[self._header_size:]) + decompressor.flush()
+        except zlib.error as error:
+            self._log.debug(f"Failed to decompress the cached output: {error}")
+            return None
+
+# ------------------------------------------------------------------------------
+class ClangTidyConfigCache:
+    """
+    Persistent cache of the output of `clang-tidy --dump-config`, which is
+    stored in the cache directory. The entries are keyed by the identity
+    of the clang-tidy binary, the flags passed to it and the `.clang-tidy` files
+    found on the path from the source directory up to the root, so that
+    clang-tidy does not need to be executed just to get its configuration.
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._dir = os.path.join(opts.cache_dir, "config")
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _stat_info(path) -> Optional[str]:
+        try:
+            st = os.stat(path)
+            return f"{path}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            return None
+
+    # --------------------------------------------------------------------------
+    def _make_key(self, ct_args_flags, source_file) -> Optional[str]:
+        binary = which(ct_args_flags[0])
+        binary_info = self._stat_info(os.path.realpath(binary))
+        if binary_info is None:
+            return None
+
+        key = hashlib.sha1()
+        key.update(binary_info.encode("utf8"))
+        key.update(json.dumps(ct_args_flags[1:]).encode("utf8"))
+        key.update(b"exclude_user_config" if self._opts.exclude_user_config() else b"")
+
+        for flag in ct_args_flags[1:]:
+            if flag.startswith("--config-file="):
+                info = self._stat_info(os.path.realpath(flag.split("=", 1)[1]))
+                key.update((info or flag).encode("utf8"))
+
+        directory = os.path.dirname(source_file)
+        while True:
+            info = self._stat_info(os.path.join(directory, ".clang-tidy"))
+            if info is not None:
+                key.update(info.encode("utf8"))
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+
+        return key.hexdigest()
+
+    # --------------------------------------------------------------------------
+    def get(self, ct_args_flags, source_file) -> Tuple[Optional[str], Optional[bytes]]:
+        "Returns the entry key and the cached config if it is available."
+        key = self._make_key(ct_args_flags, source_file)
+        if key is None:
+            return None, None
+        try:
+            with open(os.path.join(self._dir, key), "rb") as stream:
+                return key, stream.read()
+        except OSError:
+            return key, None
+
+    # --------------------------------------------------------------------------
+    def store(self, key, config: bytes) -> None:
+        try:
+            write_file_atomic(os.path.join(self._dir, key), config)
+        except OSError as error:
+            self._log.debug(f"Failed to store clang-tidy config: {error}")
+
+# ------------------------------------------------------------------------------
+def dump_config(log, opts, ct_args_flags, source_file, config_cache) -> bytes:
+    "Returns the clang-tidy config used for the specified source file."
+    import subprocess
+
+    key = None
+    if config_cache:
+        key, config = config_cache.get(ct_args_flags, source_file)
+        if config:
+            log.debug(f"Using cached clang-tidy config for {source_file}")
+            return config
+
+    ct_dump_cfg_source_file = ct_args_flags + [ "--dump-config",  source_file ]
+    proc = subprocess.Popen(
+        ct_dump_cfg_source_file,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    stdout, stderr = proc.communicate()
+    if opts.exclude_user_config():
+        stdout = remove_matching_line(stdout, "User:.*$")
+        stdout = remove_matching_line(stdout, "HeaderFilterRegex:.*$")
+
+    if (proc.returncode == 0) and (len(stdout) > 0):
+        if key:
+            config_cache.store(key, stdout)
+        return stdout
+
+    msg = f"Failed dumping the clang-tidy config with <{' '.join(ct_dump_cfg_source_file)}>"
+    raise RuntimeError(msg)
+
+# ------------------------------------------------------------------------------
+class ClangTidyManifestCache:
+    """
+    Persistent store of direct mode manifests. A manifest is keyed by the content
+    of the source files and the compiler arguments and lists every file included
+    in the translation unit together with its size, mtime and content hash.
+    It also lists the paths in the earlier include search directories, which
+    would shadow the included headers if they were created.
+    If none of the listed files changed and none of the shadowing paths exist,
+    the digest of the pre-processed output recorded in the manifest is used
+    without running the pre-processor.
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._dir = os.path.join(opts.cache_dir, "manifests")
+
+    # --------------------------------------------------------------------------
+    def _hash_file(self, path) -> str:
+        file_hash = make_hash(self._opts.hash_algorithm())
+        with open(path, "rb") as stream:
+            for chunk in iter(lambda: stream.read(1 << 16), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    # --------------------------------------------------------------------------
+    def make_key(self, source_contents: List[bytes], co_args) -> str:
+        key = hashlib.sha1()
+        compiler = which(co_args[0])
+        try:
+            st = os.stat(compiler)
+            key.update(f"{compiler}:{st.st_mtime_ns}:{st.st_size}".encode("utf8"))
+        except OSError:
+            key.update(compiler.encode("utf8"))
+        key.update(json.dumps(co_args[1:]).encode("utf8"))
+        key.update(os.getcwd().encode("utf8"))
+        for var in ["CPATH", "C_INCLUDE_PATH", "CPLUS_INCLUDE_PATH", "CTCACHE_STRIP"]:
+            key.update(os.getenv(var, "").encode("utf8"))
+        key.update(b"strip_src" if self._opts.strip_src() else b"")
+        key.update(self._opts.hash_algorithm().encode("utf8"))
+        for content in source_contents:
+            content_hash = make_hash(self._opts.hash_algorithm())
+            content_hash.update(content)
+            key.update(content_hash.hexdigest().encode("utf8"))
+        return key.hexdigest()
+
+    # --------------------------------------------------------------------------
+    def lookup(self, key) -> Optional[str]:
+        "Returns the recorded pre-processed output digest if all inputs are unchanged."
+        path = os.path.join(self._dir, key)
+        try:
+            with open(path, "rb") as stream:
+                manifest = json.loads(stream.read().decode("utf8"))
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if any(os.path.lexists(shadow) for shadow in manifest["shadows"]):
+                return None
+        except KeyError:
+            # recorded by a version not checking the search directories
+            return None
+
+        updated = False
+        for entry in manifest["files"]:
+            dep, size, mtime, digest = entry
+            try:
+                st = os.stat(dep)
+            except OSError:
+                return None
+            if st.st_size != size:
+                return None
+            if st.st_mtime_ns != mtime:
+                if self._hash_file(dep) != digest:
+                    return None
+                entry[2] = st.st_mtime_ns
+                updated = True
+
+        if updated:
+            self._write(path, manifest)
+        return manifest["result"]
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _shadows(deps: List[str], search_dirs: List[str]) -> List[str]:
+        """
+        Returns the paths in the search directories preceding the directory
+        in which each dependency was found, which do not exist now.
+        """
+        shadows = set()
+        for dep in deps:
+            # the deepest directory containing the dependency was searched
+            found = None
+            for i, directory in enumerate(search_dirs):
+                rel = os.path.relpath(dep, directory)
+                if not rel.startswith(os.pardir) and (found is None or len(rel) < len(found[1])):
+                    found = i, rel
+            if found is None:
+                continue
+            i, rel = found
+            for earlier in search_dirs[:i]:
+                shadow = os.path.join(earlier, rel)
+                if not os.path.lexists(shadow):
+                    shadows.add(shadow)
+        return sorted(shadows)
+
+    # --------------------------------------------------------------------------
+    def store(self, key, result: str, deps: List[str], co_args, start_ns: int) -> None:
+        files = []
+        deps = [os.path.abspath(d) for d in deps]
+        # the source file is listed first and its directory is searched first
+        search_dirs = include_search_dirs(co_args)
+        if deps:
+            search_dirs.insert(0, os.path.dirname(deps[0]))
+        try:
+            for dep in sorted(set(deps)):
+                st = os.stat(dep)
+                if st.st_mtime_ns >= start_ns:
+                    # the file could have been modified while being pre-processed
+                    self._log.debug(f"Not storing manifest, {dep} is too new")
+                    return
+                files.append([dep, st.st_size, st.st_mtime_ns, self._hash_file(dep)])
+        except OSError as error:
+            self._log.debug(f"Not storing manifest: {error}")
+            return
+        self._write(os.path.join(self._dir, key), {
+            "result": result,
+            "files": files,
+            "shadows": self._shadows(deps[1:], search_dirs)})
+
+    # --------------------------------------------------------------------------
+    def _write(self, path, manifest) -> None:
+        try:
+            write_file_atomic(path, json.dumps(manifest).encode("utf8"))
+        except OSError as error:
+            self._log.debug(f"Failed to store manifest: {error}")
+
+# ------------------------------------------------------------------------------
+def parse_depfile(text: str) -> List[str]:
+    "Returns the list of prerequisites from a Makefile-style depfile."
+    deps = []
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    for line in text.splitlines():
+        _, sep, rest = line.partition(": ")
+        if not sep:
+            continue
+        token = ""
+        i = 0
+        while i < len(rest):
+            c = rest[i]
+            if c == "\\" and rest[i+1:i+2] in [" ", "#"]:
+                token += rest[i+1]
+                i += 1
+            elif c == "$" and rest[i+1:i+2] == "$":
+                token += "$"
+                i += 1
+            elif c.isspace():
+                if token:
+                    deps.append(token)
+                token = ""
+            else:
+                token += c
+            i += 1
+        if token:
+            deps.append(token)
+    return deps
+
+# ------------------------------------------------------------------------------
+def include_search_dirs(co_args: List[str]) -> List[str]:
+    "Returns the explicit include search directories in the order of the search."
+    options = ["-iquote", "-I", "-isystem", "-idirafter"]
+    found = {option: [] for option in options}
+    args = iter(co_args[1:])
+    for arg in args:
+        for option in options:
+            if arg == option:
+                directory = next(args, None)
+            elif arg.startswith(option):
+                directory = arg[len(option):]
+            else:
+                continue
+            if directory:
+                found[option].append(os.path.abspath(directory))
+            break
+    result = []
+    for option in options:
+        for directory in found[option]:
+            if directory not in result:
+                result.append(directory)
+    return result
+
+# ------------------------------------------------------------------------------
+def with_depfile_args(co_args: List[str], depfile: str) -> List[str]:
+    "Replaces the dependency file generation flags in co_args."
+    result = []
+    skip_next = False
+    for arg in co_args:
+        if skip_next:
+            skip_next = False
+        elif arg in ["-MF", "-MT", "-MQ"]:
+            skip_next = True
+        elif arg in ["-MD", "-MMD", "-MP"] or arg.startswith(("-MF", "-MT", "-MQ")):
+            pass
+        else:
+            result.append(arg)
+    return result + ["-MD", "-MF", depfile]
+
+# ------------------------------------------------------------------------------
+def preprocess(log, opts, co_args, output) -> bool:
+    """
+    Streams the pre-processed output of the compiler command into the output
+    hash in chunks, so that the whole output is never held in memory.
+    Returns False if the pre-processing failed.
+    """
+    import subprocess
+    import threading
+
+    # Execute the compiler command defined by the compiler arguments. At this
+    # point if we have compiler arguments with expect that it defines a valid
+    # command to get the pre-processed output.
+    proc = subprocess.Popen(
+        co_args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    # stderr is drained concurrently so that the compiler never blocks on it
+    stderr_chunks = []
+    stderr_reader = threading.Thread(
+        target=lambda: stderr_chunks.append(proc.stderr.read()),
+        daemon=True)
+    stderr_reader.start()
+
+    with proc.stdout:
+        if opts.strip_src():
+            chunks = opts.strip_lines(proc.stdout)
+        else:
+            chunks = iter(lambda: proc.stdout.read(1 << 16), b"")
+        for chunk in chunks:
+            output.update(chunk)
+
+    stderr_reader.join()
+    proc.stderr.close()
+    proc.wait()
+    stderr = b"".join(stderr_chunks)
+
+    if opts.running_on_msvc() or opts.running_on_clang_cl():
+        if proc.returncode != 0:
+            return False
+    else:
+        if stderr:
+            log.error(f"Error executing compile command: #{co_args}.\n#{stderr}")
+            return False
+
+    return True
+
+# ------------------------------------------------------------------------------
+def preprocess_direct(log, opts, source_contents, co_args) -> Optional[bytes]:
+    """
+    Returns the digest of the pre-processed output, which is looked up in
+    a manifest or computed by running the pre-processor and then recorded.
+    """
+    manifests = ClangTidyManifestCache(log, opts)
+    key = manifests.make_key(source_contents, co_args)
+    digest = manifests.lookup(key)
+    if digest is not None:
+        log.debug(f"Direct mode manifest hit for {key}")
+        return digest.encode("utf8")
+
+    import tempfile
+
+    fd, depfile = tempfile.mkstemp(suffix=".d")
+    os.close(fd)
+    try:
+        start_ns = time.time_ns()
+        output = make_hash(opts.hash_algorithm())
+        if not preprocess(log, opts, with_depfile_args(co_args, depfile), output):
+            return None
+        digest = output.hexdigest()
+        with open(depfile, "r", encoding="utf-8", errors="replace") as stream:
+            deps = parse_depfile(stream.read())
+        manifests.store(key, digest, deps, co_args, start_ns)
+    except OSError as error:
+        log.debug(f"Direct mode failed: {error}")
+        return None
+    finally:
+        try:
+            os.unlink(depfile)
+        except OSError:
+            pass
+    return digest.encode("utf8")
+
+# ------------------------------------------------------------------------------
+class ClangTidySourceFile:
+    "A source file passed to clang-tidy, which is resolved and read only once."
+    # --------------------------------------------------------------------------
+    def __init__(self, arg: str):
+        self.arg = arg
+        self.path = os.path.normpath(os.path.realpath(arg))
+        try:
+            with open(arg, "rb") as srcfd:
+                self.data = srcfd.read()
+        except IOError:
+            self.data = None
+
+# ------------------------------------------------------------------------------
+def include_directives(source_files: List[ClangTidySourceFile]) -> List[bytes]:
+    """
+    Returns the #include directives from the source files. These are hashed so
+    that changes to the include list (which may not alter preprocessed output
+    due to include guards) still invalidate the cache. This prevents stale
+    results from checks like misc-include-cleaner that inspect the source directly.
+    """
+    directives = []
+    for source_file in source_files:
+        if source_file.data is None:
+            continue
+        srcfd = io.TextIOWrapper(
+            io.BytesIO(source_file.data), encoding="utf-8", errors="replace")
+        for line in srcfd:
+            stripped = line.strip()
+            if stripped.startswith("#"):
+                rest = stripped[1:].lstrip()
+                if rest.startswith("include"):
+                    directives.append(stripped.encode("utf-8"))
+    return directives
+
 # ------------------------------------------------------------------------------
 def remove_matching_line(byte_stream, pattern):
     text = byte_stream.decode("utf-8")
@@ -1241,88 +3796,71 @@ def hash_inputs(log, opts):
 
     result = ClangTidyCacheHash(opts)
 
-    # --- Source file content (potentially pre-processed)
-    if len(co_args) == 0:
-        for arg in ct_args[1:]:
-            if os.path.exists(arg) and _is_src_ext(arg):
-                with open(arg, "rb") as srcfd:
-                    src_data_binary = srcfd.read()
-                    if opts.strip_src():
-                        src_data = src_data_binary.decode(encoding="utf-8")
-                        src_data = opts.strip_paths(src_data)
-                        src_data_binary = src_data.encode("utf-8")
-                    result.update(src_data_binary)
-    else:
-        # Execute the compiler command defined by the compiler arguments. At this
-        # point if we have compiler arguments with expect that it defines a valid
-        # command to get the pre-processed output.
-        # If we have a valid output this gets added to the hash.
-        proc = subprocess.Popen(
-            co_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = proc.communicate()
-        if opts.running_on_msvc() or opts.running_on_clang_cl():
-            if proc.returncode != 0:
-                return None
-        else:
-            if stderr:
-                log.error(f"Error executing compile command: #{co_args}.\n#{stderr}")
-                return None
-
-        if opts.strip_src():
-            stdout_str = stdout.decode(encoding="utf-8")
-            stdout_str = opts.strip_paths(stdout_str)
-            stdout = stdout_str.encode("utf-8")
-
-        result.update(stdout)
-
-        # Hash #include directives from source files so that changes to the include list
-        # (which may not alter preprocessed output due to include guards) still invalidate the cache.
-        # This prevents stale results from checks like misc-include-cleaner that inspect the source directly.
-        for arg in ct_args[1:]:
-            if os.path.exists(arg) and _is_src_ext(arg):
-                try:
-                    with open(arg, "r", encoding="utf-8", errors="replace") as srcfd:
-                        for line in srcfd:
-                            stripped = line.strip()
-                            if stripped.startswith("#"):
-                                rest = stripped[1:].lstrip()
-                                if rest.startswith("include"):
-                                    result.update(stripped.encode("utf-8"))
-                except IOError:
-                    pass
-
     # --- Config Contents ------------------------------------------------------
     # (as obtained by running clang-tidy with --dump-config flag)
+    # The configs and the #include directives are obtained concurrently with
+    # the source file content, but they are added to the hash afterwards
+    # in the same order as if they were obtained sequentially.
 
+    # Each source file is resolved and read only once and its contents are
+    # shared by the content hash, the #include directives and the direct mode.
     ct_args_flags = [ ct_args[0] ]
     source_files = []
+    resolved = {}
 
     for arg in ct_args[1:]:
-        if os.path.exists(arg) and _is_src_ext(arg):
-            source_files.append(os.path.normpath(os.path.realpath(arg)))
+        if _is_src_ext(arg) and os.path.exists(arg):
+            if arg not in resolved:
+                resolved[arg] = ClangTidySourceFile(arg)
+            source_files.append(resolved[arg])
         else:
             ct_args_flags.append(arg)
 
-    for source_file in sorted(source_files):
-        ct_dump_cfg_source_file = ct_args_flags + [ "--dump-config",  source_file ]
-        proc = subprocess.Popen(
-            ct_dump_cfg_source_file,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = proc.communicate()
-        if opts.exclude_user_config():
-            stdout = remove_matching_line(stdout, "User:.*$")
-            stdout = remove_matching_line(stdout, "HeaderFilterRegex:.*$")
-
-        if (proc.returncode == 0) and (len(stdout) > 0):
-            result.update(stdout)
+    config_files = [source_file.path for source_file in source_files]
+
+    config_cache = None
+    if not opts.no_config_cache():
+        config_cache = ClangTidyConfigCache(log, opts)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(config_files) + 1) as executor:
+        configs = [
+            executor.submit(dump_config, log, opts, ct_args_flags, source_file, config_cache)
+            for source_file in sorted(config_files)
+        ]
+        includes = None
+
+        # --- Source file content (potentially pre-processed)
+        if len(co_args) == 0:
+            for source_file in source_files:
+                src_data_binary = source_file.data
+                if src_data_binary is None:
+                    raise IOError(f"Failed reading source file {source_file.arg}")
+                if opts.strip_src():
+                    src_data = src_data_binary.decode(encoding="utf-8")
+                    src_data = opts.strip_paths(src_data)
+                    src_data_binary = src_data.encode("utf-8")
+                result.update(src_data_binary)
         else:
-            msg = f"Failed dumping the clang-tidy config with <{' '.join(ct_dump_cfg_source_file)}>"
-            raise RuntimeError(msg)
+            includes = executor.submit(include_directives, source_files)
+
+            # If we have a valid pre-processed output (or its digest in direct mode)
+            # this gets added to the hash.
+            if opts.direct_mode():
+                source_contents = [source_file.data or bytes() for source_file in source_files]
+                digest = preprocess_direct(log, opts, source_contents, co_args)
+                if digest is None:
+                    return None
+                result.update(digest)
+            elif not preprocess(log, opts, co_args, result):
+                return None
+
+        if includes is not None:
+            for directive in includes.result():
+                result.update(directive)
+
+        for config in configs:
+            result.update(config.result())
 
     # --- Clang-Tidy and Compiler Args -----------------------------------------
 
@@ -1344,11 +3882,13 @@ def hash_inputs(log, opts):
         if not opts.exclude_hash(chunk):
             result.update(chunk)
 
+    opts.path_memo().save()
     return result.hexdigest()
 
 # ------------------------------------------------------------------------------
 def print_usage():
     print("Usage: clang-tidy-cache /path/to/real/clang-tidy [[cache-options] --] <clang-tidy-options>")
+    print("       clang-tidy-cache --batch [/path/to/real/clang-tidy] -p <build-path> [<clang-tidy-options>] [<files>]")
 # ------------------------------------------------------------------------------
 def print_stats(log, opts, raw):
     def _format_bytes(s):
@@ -1394,11 +3934,16 @@ def print_stats(log, opts, raw):
         ("Cleaned ago", lambda o, s: _format_time(s["remote"]["cleaned_seconds_ago"])),
         ("Saved ago", lambda o, s: _format_time(s["remote"]["saved_seconds_ago"])),
         ("Uptime", lambda o, s: _format_time(s["remote"]["uptime_seconds"])),
+        ("Backend hits", lambda o, s: ", ".join(
+            "%s: %d" % (k, v) for k, v in sorted(s["remote"]["backend_hit_count"].items())) or "0"),
+        ("Time saved", lambda o, s: _format_time(s["remote"]["time_saved_seconds"])),
         ("Hit rate (local)", lambda o, s: "%.1f %%" % (s["local"]["hit_rate"] * 100.0)),
         ("Hit count (local)", lambda o, s: "%d" % s["local"]["hit_count"]),
         ("Miss count (local)", lambda o, s: "%d" % s["local"]["miss_count"]),
         ("Miss rate (local)", lambda o, s: "%.1f %%" % (s["local"]["miss_rate"] * 100.0)),
-        ("Cached hashes (local)", lambda o, s: "%d" % s["local"]["cached_count"])
+        ("Cached hashes (local)", lambda o, s: "%d" % s["local"]["cached_count"]),
+        ("Cache size (local)", lambda o, s: _format_bytes(s["local"]["cached_size_bytes"])),
+        ("Time saved (local)", lambda o, s: _format_time(s["local"]["time_saved_seconds"]))
     ]
 
     max_len = max(len(e[0]) for e in entries)
@@ -1416,14 +3961,61 @@ def clear_stats(log, opts):
     cache.clear_stats(opts)
 
 # ------------------------------------------------------------------------------
-def run_clang_tidy_cached(log, opts):
-    cache = ClangTidyCache(log, opts)
+def run_clang_tidy(args: List[str]) -> Tuple[int, bytes, bytes]:
+    "Runs the real clang-tidy and returns its exit code, stdout and stderr."
+    import subprocess
+
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    stdout, stderr = proc.communicate()
+    return proc.returncode, stdout, stderr
+
+# ------------------------------------------------------------------------------
+def store_clang_tidy_result(log, opts, cache, digest, returncode: int, stdout: bytes, codec=None) -> None:
+    "Stores the result of a clang-tidy run in the cache if it should be cached."
+    tidy_success = True
+    if returncode != 0:
+        tidy_success = False
+
+    if stdout and not opts.ignore_output():
+        tidy_success = False
+
+    # saving the result even in case clang-tidy wasn't successful is only meaningful
+    # if the output is actually stored. Only then the exit code can be retained
+    # (as the first byte in the corresponding key's value)
+    save_even_without_success = opts.save_all() and opts.save_output()
+
+    if (tidy_success or save_even_without_success) and digest:
+        try:
+            if opts.save_output():
+                # Mask to low byte for single-byte encoding;
+                # on Windows, crash codes like 0xC0000005 would overflow bytes()
+                rc = returncode & 0xFF
+                returncode_and_ct_output = bytes([rc]) + stdout
+                if codec is None:
+                    codec = ClangTidyOutputCodec(log, opts)
+                cache.store_in_cache_with_data(digest, codec.encode(returncode_and_ct_output))
+            else:
+                cache.store_in_cache(digest)
+        except Exception as error:
+            log.error(str(error))
+
+# ------------------------------------------------------------------------------
+def run_clang_tidy_cached(log, opts, cache=None):
+    if cache is None:
+        cache = ClangTidyCache(log, opts)
     digest = None
+    codec = ClangTidyOutputCodec(log, opts)
     try:
         digest = hash_inputs(log, opts)
         if digest and opts.save_output():
             data = cache.get_cache_data(digest)
             if data is not None:
+                data = codec.decode(data)
+            if data:
                 returncode = int(data[0])
                 sys.stdout.write(data[1:].decode("utf8"))
                 return returncode
@@ -1439,50 +4031,311 @@ def run_clang_tidy_cached(log, opts):
         log.debug(f"Digest {digest} does not exist in cache.")
     log.debug(f"Calling real clang-tidy.")
 
-    proc = subprocess.Popen(
-        opts.original_args(),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = proc.communicate()
+    start = time.monotonic()
+    returncode, stdout, stderr = run_clang_tidy(opts.original_args())
+    if digest:
+        cache.record_run(time.monotonic() - start)
     sys.stdout.write(stdout.decode("utf8"))
     sys.stderr.write(stderr.decode("utf8"))
 
-    tidy_success = True
-    if proc.returncode != 0:
-        tidy_success = False
+    store_clang_tidy_result(log, opts, cache, digest, returncode, stdout, codec)
+    return returncode
 
-    if stdout and not opts.ignore_output():
-        tidy_success = False
+# ------------------------------------------------------------------------------
+def hash_batch_entry(log, args: List[str]) -> Optional[str]:
+    "Returns the digest of a single translation unit in batch mode."
+    try:
+        return hash_inputs(log, ClangTidyCacheOpts(log, args))
+    except Exception as error:
+        log.error(str(error))
+        return None
 
-    # saving the result even in case clang-tidy wasn't successful is only meaningful
-    # if the output is actually stored. Only then the exit code can be retained
-    # (as the first byte in the corresponding key's value)
-    save_even_without_success = opts.save_all() and opts.save_output()
+# ------------------------------------------------------------------------------
+class ClangTidyCacheBatch:
+    """
+    Runs clang-tidy cached on all (or the specified) translation units from
+    a compile command DB in a single process:
 
-    if (tidy_success or save_even_without_success) and digest:
+        clang-tidy-cache --batch [clang-tidy] -p <build-path> [options] [files]
+
+    The DB is loaded once, the inputs are hashed in parallel, the cache is
+    queried with a single bulk lookup and the real clang-tidy is only executed
+    for the misses on a pool of workers sized to the number of CPUs.
+    The results are stored as each clang-tidy run finishes.
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._codec = ClangTidyOutputCodec(log, opts)
+        self._clang_tidy = "clang-tidy"
+        # the -p argument as given, which is part of the hashed arguments
+        self._db_arg = None
+        self._db_path = None
+        self._flags = []
+        self._files = []
+        self._parse_args(opts.original_args()[1:])
+
+    # --------------------------------------------------------------------------
+    def _parse_args(self, args: List[str]) -> None:
+        if args and not args[0].startswith("-"):
+            self._clang_tidy = args[0]
+            args = args[1:]
+        self._clang_tidy = which(self._clang_tidy)
+
+        args = iter(args)
+        for arg in args:
+            if arg == "-p":
+                self._db_arg = next(args, None)
+            elif arg.startswith("-p="):
+                self._db_arg = arg[3:]
+            elif arg.startswith("-"):
+                self._flags.append(arg)
+            else:
+                self._files.append(arg)
+
+        if not self._db_arg:
+            raise ValueError("Batch mode requires -p <build-path>")
+        self._db_path = self._db_arg
+        if os.path.isdir(self._db_path):
+            self._db_path = os.path.join(self._db_path, "compile_commands.json")
+
+    # --------------------------------------------------------------------------
+    def _translation_units(self) -> Tuple[List[str], bool]:
+        "Returns the selected source files and if all of them were found."
+        commands = self._opts.load_compile_commands(self._db_path)
+        if self._files:
+            selected = set(ClangTidyCompileDbIndex.normalize(f) for f in self._files)
+            missing = selected - set(commands)
+            for filename in sorted(missing):
+                self._log.error(f"{filename} not found in {self._db_path}")
+            return [filename for filename in commands if filename in selected], not missing
+        return list(commands), True
+
+    # --------------------------------------------------------------------------
+    def _tu_args(self, filename: str) -> List[str]:
+        # the same arguments as of a separate clang-tidy invocation, so that
+        # the batch and the regular runs share the cached results
+        return [self._clang_tidy] + self._flags + ["-p", self._db_arg, filename]
+
+    # --------------------------------------------------------------------------
+    def _hash_all(self, tu_args: List[List[str]]) -> List[Optional[str]]:
+        from concurrent.futures import ProcessPoolExecutor
+
+        if len(tu_args) < 2:
+            return [hash_batch_entry(self._log, args) for args in tu_args]
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return list(executor.map(
+                hash_batch_entry, [self._log] * len(tu_args), tu_args))
+
+    # --------------------------------------------------------------------------
+    def _lookup_all(self, cache, digests: List[str]) -> dict:
+        "Returns the return code and the output of each cached digest."
+        result = {}
         try:
-            if opts.save_output():
-                # Mask to low byte for single-byte encoding;
-                # on Windows, crash codes like 0xC0000005 would overflow bytes()
-                rc = proc.returncode & 0xFF
-                returncode_and_ct_output = bytes([rc]) + stdout
-                cache.store_in_cache_with_data(digest, returncode_and_ct_output)
+            if self._opts.save_output():
+                for digest, data in get_cache_data_many(cache, digests).items():
+                    if data is not None:
+                        data = self._codec.decode(data)
+                    if data:
+                        result[digest] = (int(data[0]), data[1:])
             else:
-                cache.store_in_cache(digest)
+                for digest, found in is_cached_many(cache, digests).items():
+                    if found:
+                        result[digest] = (0, bytes())
         except Exception as error:
-            log.error(str(error))
+            self._log.error(str(error))
+        return result
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _timed_run(args):
+        start = time.monotonic()
+        returncode, stdout, stderr = run_clang_tidy(args)
+        return returncode, stdout, stderr, time.monotonic() - start
+
+    # --------------------------------------------------------------------------
+    def run(self, cache=None) -> int:
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        if cache is None:
+            cache = ClangTidyCache(self._log, self._opts)
 
-    return proc.returncode
+        filenames, all_found = self._translation_units()
+        tu_args = [self._tu_args(filename) for filename in filenames]
+        digests = self._hash_all(tu_args)
+        cached = self._lookup_all(cache, sorted(set(d for d in digests if d)))
+        self._log.debug(f"Batch of {len(tu_args)} translation units, {len(cached)} cached")
+
+        failed = not all_found
+        misses = []
+        for args, digest in zip(tu_args, digests):
+            if digest in cached:
+                returncode, stdout = cached[digest]
+                sys.stdout.write(stdout.decode("utf8"))
+                failed = failed or returncode != 0
+            else:
+                misses.append((args, digest))
+        sys.stdout.flush()
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            runs = {
+                executor.submit(self._timed_run, args): digest
+                for args, digest in misses
+            }
+            for run in as_completed(runs):
+                returncode, stdout, stderr, seconds = run.result()
+                if runs[run]:
+                    cache.record_run(seconds)
+                sys.stdout.write(stdout.decode("utf8"))
+                sys.stderr.write(stderr.decode("utf8"))
+                sys.stdout.flush()
+                failed = failed or returncode != 0
+                store_clang_tidy_result(
+                    self._log, self._opts, cache, runs[run], returncode, stdout, self._codec)
+
+        return 1 if failed else 0
+
+# ------------------------------------------------------------------------------
+class ClangTidyCacheWorker:
+    """
+    Long-lived process serving clang-tidy-cache invocations forwarded by
+    the clang_tidy_cache_shim.py client over a Unix domain socket.
+    Each invocation is handled in a forked child process, which inherits the
+    already imported modules and the constructed cache backends from the worker
+    and runs with the environment, working directory and standard streams
+    of the forwarding client. The connections and the in-memory memos created
+    by a child are discarded when it exits.
+    """
+    # --------------------------------------------------------------------------
+    def __init__(self, log, opts):
+        self._log = log
+        self._opts = opts
+        self._socket_path = opts.worker_socket()
+        self._env = self._ctcache_env(os.environ)
+        # The backend clients are only constructed here and not used, so that
+        # no connections are shared between the forked request handlers.
+        self._cache = ClangTidyCache(log, opts)
+        self._cache.warm_up()
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _ctcache_env(env) -> dict:
+        return {k: v for k, v in env.items() if k.startswith("CTCACHE_")}
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def _receive_request(sock):
+        import array
+        import socket
+
+        fds = array.array("i")
+        msg, ancdata, _, _ = sock.recvmsg(
+            65536, socket.CMSG_SPACE(3 * fds.itemsize))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+        while not msg.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            msg += chunk
+        return json.loads(msg.decode("utf8")), list(fds)
+
+    # --------------------------------------------------------------------------
+    def handle(self, sock):
+        returncode = 1
+        try:
+            request, fds = self._receive_request(sock)
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+            for fd in fds:
+                os.close(fd)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+
+            cache = None
+            if self._ctcache_env(os.environ) == self._env:
+                cache = self._cache
+            returncode = main(request["args"], cache)
+        except SystemExit as exit:
+            # reported like the interpreter would report it
+            if exit.code is None or isinstance(exit.code, int):
+                returncode = exit.code or 0
+            else:
+                print(exit.code, file=sys.stderr)
+        except Exception as error:
+            self._log.error("Worker failed handling request: %s", repr(error))
+        finally:
+            # the client waits for the exit status in any case
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                sock.sendall(json.dumps({"returncode": returncode}).encode("utf8") + b"\n")
+            except (OSError, ValueError):
+                pass
+
+    # --------------------------------------------------------------------------
+    def _remove_stale_socket(self) -> None:
+        import socket
+
+        if not os.path.exists(self._socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self._socket_path)
+        except OSError:
+            os.unlink(self._socket_path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"Another worker is listening on {self._socket_path}")
+
+    # --------------------------------------------------------------------------
+    def serve(self) -> None:
+        import signal
+        import socketserver
+
+        worker = self
+
+        class _Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                worker.handle(self.request)
+
+        class _Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+            max_children = self._opts.worker_max_jobs()
+
+        socket_dir = os.path.dirname(os.path.abspath(self._socket_path))
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        st = os.stat(socket_dir)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            self._log.warning(
+                "The worker socket directory %s is accessible by other users, "
+                "the shim does not forward invocations to it", socket_dir)
+        self._remove_stale_socket()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with _Server(self._socket_path, _Handler) as server:
+            os.chmod(self._socket_path, 0o600)
+            self._log.info("Worker listening on %s", self._socket_path)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                try:
+                    os.unlink(self._socket_path)
+                except OSError:
+                    pass
 
 # ------------------------------------------------------------------------------
-def main():
+def main(args: Optional[List[str]] = None, cache=None):
     log = logging.getLogger(os.path.basename(__file__))
     logging.basicConfig()
     debug = False
     opts = None
     try:
-        opts = ClangTidyCacheOpts(log, sys.argv[1:])
+        opts = ClangTidyCacheOpts(log, sys.argv[1:] if args is None else args)
         log.setLevel(opts.log_level())
         debug = opts.debug_enabled()
         if opts.should_print_usage():
@@ -1490,6 +4343,7 @@ def main():
         elif opts.should_print_dir():
             print(opts.cache_dir)
         elif opts.should_remove_dir():
+            import shutil
             try:
                 shutil.rmtree(opts.cache_dir)
             except FileNotFoundError:
@@ -1500,8 +4354,21 @@ def main():
             print_stats(log, opts, True)
         elif opts.should_zero_stats():
             clear_stats(log, opts)
+        elif opts.should_run_worker():
+            ClangTidyCacheWorker(log, opts).serve()
+        elif opts.should_upload_spool():
+            ClangTidyCache(log, opts).upload_spool()
+        elif opts.should_reconcile_stats():
+            make_local_cache(log, opts).reconcile_stats()
+        elif opts.should_trim_local():
+            evicted = make_local_cache(log, opts).trim()
+            print("Evicted %d entries from the local cache" % evicted)
+        elif opts.should_compact_local():
+            make_local_cache(log, opts).compact()
+        elif opts.should_run_batch():
+            return ClangTidyCacheBatch(log, opts).run(cache)
         else:
-            return run_clang_tidy_cached(log, opts)
+            return run_clang_tidy_cached(log, opts, cache)
         return 0
     except Exception as error:
         if debug:
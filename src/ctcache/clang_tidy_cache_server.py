@@ -14,6 +14,9 @@ import json
 import time
 import gzip
 import flask
+import array
+import struct
+import hashlib
 import shutil
 import argparse
 import matplotlib.pyplot as plt
@@ -160,6 +163,17 @@ class ArgumentParser(argparse.ArgumentParser):
             If specified, all non-GET requests must supply matching ?key=STRING or are rejected (403).
             """)
 
+        self.add_argument(
+            "--output-dict",
+            dest="output_dict_path",
+            metavar="FILE-PATH",
+            type=os.path.realpath,
+            default=None,
+            help="""
+            Specifies the path to the dictionary for the compression of the cached
+            outputs, which is served to the clients.
+            """)
+
     # -------------------------------------------------------------------------
     def process_parsed_options(self, options):
         return options
@@ -193,6 +207,15 @@ class CacheFile():
         f.write(data)
         f.close()
 
+    # -------------------------------------------------------------------------
+    def load(self):
+        try:
+            with open(self._filepath, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            # file already removed
+            return None
+
     # -------------------------------------------------------------------------
     def remove(self):
         try:
@@ -218,6 +241,308 @@ class CacheFile():
             return 0
 
 
+# ------------------------------------------------------------------------------
+class BloomFilter():
+    """
+    Bloom filter of the cached hashes published to the clients, which can skip
+    the lookups of hashes that are definitely not cached. The serialized form
+    is a "<8sII" header (magic, number of bits, number of hash functions)
+    followed by the bit array. The bit positions of a key are derived from
+    the SHA-1 of the key by double hashing (see ClangTidyBloomFilter
+    in clang_tidy_cache.py, which must be kept in sync).
+    """
+    _magic = b"CTCBLOOM"
+    _header = "<8sII"
+
+    # -------------------------------------------------------------------------
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1024)
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._bit_count = int(math.ceil(bits / 8.0)) * 8
+        self._hash_count = max(1, int(round(self._bit_count / capacity * math.log(2))))
+        self._capacity = capacity
+        self._count = 0
+        self._bits = bytearray(self._bit_count // 8)
+
+    # -------------------------------------------------------------------------
+    def _positions(self, key):
+        d = hashlib.sha1(key.encode("utf8")).digest()
+        h1 = int.from_bytes(d[0:8], "little")
+        h2 = int.from_bytes(d[8:16], "little") | 1
+        return ((h1 + i * h2) % self._bit_count for i in range(self._hash_count))
+
+    # -------------------------------------------------------------------------
+    def is_full(self):
+        return self._count >= self._capacity
+
+    # -------------------------------------------------------------------------
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self._count += 1
+
+    # -------------------------------------------------------------------------
+    def serialize(self):
+        header = struct.pack(self._header, self._magic, self._bit_count, self._hash_count)
+        return header + bytes(self._bits)
+
+# ------------------------------------------------------------------------------
+class CacheMetadata():
+    """
+    Compact store of the hit count, insert and access time of the cached hashes.
+    The values are kept in parallel typed arrays indexed by slots, the slots of
+    removed hashes are reused. SHA-1 hashes are stored as 20-byte binary keys
+    in a single buffer and found through an open-addressing hash table of slot
+    indices (linear probing, backward-shift deletion), so there are no per-hash
+    Python objects. The rare hashes of other algorithms are kept in a dict.
+    The times are whole seconds since the epoch.
+    """
+    _key_size = 20
+    _empty = -1
+    _max_value = 0xFFFFFFFF
+    _min_table_size = 1024
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        self.clear()
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        self._keys = bytearray()
+        self._hits = array.array("I")
+        self._insert_time = array.array("I")
+        self._access_time = array.array("I")
+        self._free = array.array("I")
+        self._table = array.array("i", [self._empty]) * self._min_table_size
+        self._count = 0
+        self._other = dict()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sha1_key(hashstr):
+        "Returns the binary key of a SHA-1 hash, None for other hashes."
+        if len(hashstr) == 40:
+            try:
+                key = bytes.fromhex(hashstr)
+                if key.hex() == hashstr:
+                    return key
+            except ValueError:
+                pass
+        return None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _value(cls, value):
+        "Converts the value to an integer in the range of the arrays."
+        return min(max(int(value), 0), cls._max_value)
+
+    # -------------------------------------------------------------------------
+    def _slot_key(self, slot):
+        return self._keys[slot * self._key_size:(slot + 1) * self._key_size]
+
+    # -------------------------------------------------------------------------
+    def _home(self, key):
+        return int.from_bytes(key[:8], "little") & (len(self._table) - 1)
+
+    # -------------------------------------------------------------------------
+    def _probe(self, key):
+        "Returns the position of the key in the table or where it belongs."
+        table = self._table
+        keys = self._keys
+        size = self._key_size
+        mask = len(table) - 1
+        pos = int.from_bytes(key[:8], "little") & mask
+        while True:
+            slot = table[pos]
+            if slot == self._empty or keys[slot * size:(slot + 1) * size] == key:
+                return pos
+            pos = (pos + 1) & mask
+
+    # -------------------------------------------------------------------------
+    def _resize(self, size):
+        old_table = self._table
+        table = self._table = array.array("i", [self._empty]) * size
+        keys = self._keys
+        key_size = self._key_size
+        mask = size - 1
+        for slot in old_table:
+            if slot != self._empty:
+                offset = slot * key_size
+                pos = int.from_bytes(keys[offset:offset + 8], "little") & mask
+                while table[pos] != self._empty:
+                    pos = (pos + 1) & mask
+                table[pos] = slot
+
+    # -------------------------------------------------------------------------
+    def _unplace(self, pos):
+        # shifts back the following entries which would not be found otherwise
+        table = self._table
+        mask = len(table) - 1
+        i = j = pos
+        while True:
+            j = (j + 1) & mask
+            slot = table[j]
+            if slot == self._empty:
+                break
+            k = self._home(self._slot_key(slot))
+            if (i <= j and (k <= i or k > j)) or (i > j and k <= i and k > j):
+                table[i] = slot
+                i = j
+        table[i] = self._empty
+
+    # -------------------------------------------------------------------------
+    def _new_slot(self):
+        if self._free:
+            return self._free.pop()
+        self._keys.extend(bytes(self._key_size))
+        self._hits.append(0)
+        self._insert_time.append(0)
+        self._access_time.append(0)
+        return len(self._hits) - 1
+
+    # -------------------------------------------------------------------------
+    def _slot(self, hashstr):
+        key = self._sha1_key(hashstr)
+        if key is None:
+            return self._other.get(hashstr)
+        slot = self._table[self._probe(key)]
+        return None if slot == self._empty else slot
+
+    # -------------------------------------------------------------------------
+    def _slots(self):
+        "Yields the slots of all stored hashes with the hashes."
+        for slot in self._table:
+            if slot != self._empty:
+                yield slot, self._slot_key(slot).hex()
+        for hashstr, slot in self._other.items():
+            yield slot, hashstr
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        return self._count + len(self._other)
+
+    # -------------------------------------------------------------------------
+    def __contains__(self, hashstr):
+        return self._slot(hashstr) is not None
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        return (hashstr for _, hashstr in self._slots())
+
+    # -------------------------------------------------------------------------
+    def items(self):
+        "Yields the hashes with their info dictionaries."
+        for slot, hashstr in self._slots():
+            yield hashstr, {
+                "hits": self._hits[slot],
+                "insert_time": self._insert_time[slot],
+                "access_time": self._access_time[slot]
+            }
+
+    # -------------------------------------------------------------------------
+    def hits(self):
+        return (self._hits[slot] for slot, _ in self._slots())
+
+    # -------------------------------------------------------------------------
+    def insert_times(self):
+        return (self._insert_time[slot] for slot, _ in self._slots())
+
+    # -------------------------------------------------------------------------
+    def by_access_time(self):
+        "Returns the hashes sorted from the least recently accessed."
+        access_time = self._access_time
+        slots = sorted(self._slots(), key=lambda item: access_time[item[0]])
+        return [hashstr for _, hashstr in slots]
+
+    # -------------------------------------------------------------------------
+    def touch(self, hashstr):
+        "Records an access of the hash, returns False if it is not stored."
+        slot = self._slot(hashstr)
+        if slot is None:
+            return False
+        self._access_time[slot] = int(time.time())
+        self._hits[slot] = min(self._hits[slot] + 1, self._max_value)
+        return True
+
+    # -------------------------------------------------------------------------
+    def insert(self, hashstr, hits=1, insert_time=None, access_time=None):
+        # the values are converted before a slot is taken, so that invalid
+        # values do not leave partially inserted hashes behind
+        now = int(time.time())
+        hits = self._value(hits)
+        insert_time = now if insert_time is None else self._value(insert_time)
+        access_time = now if access_time is None else self._value(access_time)
+        key = self._sha1_key(hashstr)
+        if key is None:
+            slot = self._other.get(hashstr)
+            if slot is None:
+                slot = self._other[hashstr] = self._new_slot()
+        else:
+            if 2 * (self._count + 1) > len(self._table):
+                self._resize(2 * len(self._table))
+            pos = self._probe(key)
+            slot = self._table[pos]
+            if slot == self._empty:
+                slot = self._table[pos] = self._new_slot()
+                self._keys[slot * self._key_size:(slot + 1) * self._key_size] = key
+                self._count += 1
+        self._hits[slot] = hits
+        self._insert_time[slot] = insert_time
+        self._access_time[slot] = access_time
+
+    # -------------------------------------------------------------------------
+    def remove(self, hashstr):
+        key = self._sha1_key(hashstr)
+        if key is None:
+            slot = self._other.pop(hashstr, None)
+        else:
+            pos = self._probe(key)
+            slot = self._table[pos]
+            if slot == self._empty:
+                return
+            self._unplace(pos)
+            self._count -= 1
+        if slot is not None:
+            self._free.append(slot)
+
+    # -------------------------------------------------------------------------
+    def save(self, f):
+        """
+        Writes the metadata as a JSON object with one hash per line,
+        which can be loaded without parsing the whole file at once.
+        """
+        f.write("{")
+        separator = "\n"
+        for slot, hashstr in self._slots():
+            f.write('%s"%s": {"hits": %d, "insert_time": %d, "access_time": %d}' % (
+                separator, hashstr,
+                self._hits[slot], self._insert_time[slot], self._access_time[slot]))
+            separator = ",\n"
+        f.write("\n}\n")
+
+    # -------------------------------------------------------------------------
+    def _load_entries(self, f):
+        first = f.readline()
+        if first.strip() != "{":
+            # a single-line JSON object written by the previous versions
+            first += f.read()
+            return json.loads(first).items()
+        return (
+            item
+            for line in f
+            if line.strip() not in ["", "}"]
+            for item in json.loads("{%s}" % line.strip().rstrip(",")).items())
+
+    # -------------------------------------------------------------------------
+    def load(self, f, is_valid_hash):
+        for hashstr, data in self._load_entries(f):
+            if is_valid_hash(hashstr):
+                try:
+                    self.insert(
+                        hashstr, data["hits"], data["insert_time"], data["access_time"])
+                except (KeyError, TypeError, ValueError, OverflowError):
+                    pass
+
 # ------------------------------------------------------------------------------
 class ClangTidyCacheApp(flask.Flask):
     # --------------------------------------------------------------------------
@@ -250,9 +575,13 @@ class ClangTidyCacheApp(flask.Flask):
 clang_tidy_cache = None
 ctcache_app = ClangTidyCacheApp()
 
+# endpoints which only read the cache, even though they are not called with GET
+_ctc_read_only_endpoints = {"ctc_cache_many"}
+
 @ctcache_app.before_request
 def _ctc_auth_writes():
-    if flask.request.method != 'GET':
+    if flask.request.method != 'GET' and \
+            flask.request.endpoint not in _ctc_read_only_endpoints:
         if clang_tidy_cache.auth_key_writes and flask.request.args.get("key") != clang_tidy_cache.auth_key_writes:
             flask.abort(403)
 
@@ -264,7 +593,7 @@ class ClangTidyCache(object):
         self._cleaned_count = 0
         self._hits_count = 0
         self._miss_count = 0
-        self._cached = dict()
+        self._cached = CacheMetadata()
         self._stats = list()
         self._save_path = options.save_path
         self._save_interval = options.save_interval
@@ -274,6 +603,7 @@ class ClangTidyCache(object):
         self._chart_path = options.chart_path
         self._max_cache_size = options.max_cache_size
         self._auth_key_writes = options.auth_key_writes
+        self._output_dict_path = options.output_dict_path
         #
         self._info_getters = {
             "static_path": self.static_path,
@@ -300,9 +630,36 @@ class ClangTidyCache(object):
         self._save_time = time.time()
         self._cleanup_time = time.time()
         #
-        self._hash_re = re.compile(r'^[0-9a-fA-F]{40}$')
+        # SHA-1 keys or keys from other hash algorithms with the algorithm ID
+        self._hash_re = re.compile(r'^[0-9a-fA-F]{32,64}(-[0-9a-z]+)?$')
         #
         self.do_load()
+        self._bloom_filter = None
+        self._bloom_filter_data = None
+        self.rebuild_bloom_filter()
+
+    # --------------------------------------------------------------------------
+    def rebuild_bloom_filter(self):
+        # hashes cannot be removed from a Bloom filter, so it is rebuilt after
+        # cleanups, with spare capacity for the hashes added incrementally
+        self._bloom_filter = BloomFilter(2 * len(self._cached))
+        for hashstr in self._cached:
+            self._bloom_filter.add(hashstr)
+        self._bloom_filter_data = None
+
+    # --------------------------------------------------------------------------
+    def _add_to_bloom_filter(self, hashstr):
+        if self._bloom_filter.is_full():
+            self.rebuild_bloom_filter()
+        else:
+            self._bloom_filter.add(hashstr)
+            self._bloom_filter_data = None
+
+    # --------------------------------------------------------------------------
+    def bloom_filter_data(self):
+        if self._bloom_filter_data is None:
+            self._bloom_filter_data = self._bloom_filter.serialize()
+        return self._bloom_filter_data
 
     # --------------------------------------------------------------------------
     def maintain(self):
@@ -334,7 +691,8 @@ class ClangTidyCache(object):
         for hashstr in self._cached:
             CacheFile(hashstr).remove()
 
-        self._cached = dict()
+        self._cached.clear()
+        self.rebuild_bloom_filter()
         self.do_save()
         return "success"
 
@@ -347,8 +705,7 @@ class ClangTidyCache(object):
     # --------------------------------------------------------------------------
     def _remove_cache_file(self, hashstr):
         CacheFile(hashstr).remove()
-        if hashstr in self._cached:
-            del self._cached[hashstr]
+        self._cached.remove(hashstr)
 
     # --------------------------------------------------------------------------
     def _do_cleanup_by_metric(self):
@@ -369,8 +726,7 @@ class ClangTidyCache(object):
         if saved_cache_size <= self._max_cache_size:
             return
 
-        cached_items = sorted(self._cached.items(), key = lambda v: v[1]['access_time'])
-        for hashstr, _ in cached_items:
+        for hashstr in self._cached.by_access_time():
             if saved_cache_size <= self._max_cache_size:
                 return
 
@@ -390,20 +746,14 @@ class ClangTidyCache(object):
 
         after = len(self._cached)
         self._cleaned_count += (before - after)
+        if after < before:
+            self.rebuild_bloom_filter()
 
     # --------------------------------------------------------------------------
     def do_load(self):
         try:
             with gzip.open(self._save_path, 'rt', encoding="utf8") as dbf:
-                for hashstr, data in json.load(dbf).items():
-                    if self.is_valid_hash(hashstr):
-                        try:
-                            info = self._cached[hashstr] = dict()
-                            info["hits"] = data["hits"]
-                            info["insert_time"] = data["insert_time"]
-                            info["access_time"] = data["access_time"]
-                        except KeyError:
-                            pass
+                self._cached.load(dbf, self.is_valid_hash)
         except Exception as err:
             print(f"Failed to load cache data: {err}", file=sys.stderr)
 
@@ -411,7 +761,7 @@ class ClangTidyCache(object):
     def do_save(self):
         try:
             with gzip.open(self._save_path, 'wt', encoding="utf8") as dbf:
-                json.dump(self._cached, dbf)
+                self._cached.save(dbf)
         except Exception:
             pass
 
@@ -454,30 +804,45 @@ class ClangTidyCache(object):
     def cache(self, hashstr, data):
         CacheFile(hashstr).save(data)
 
-        try:
-            info = self._cached[hashstr]
-            info["access_time"] = time.time()
-            info["hits"] += 1
-        except KeyError:
-            self._cached[hashstr] = {
-                "insert_time": time.time(),
-                "access_time": time.time(),
-                "hits": 1,
-            }
+        if not self._cached.touch(hashstr):
+            self._cached.insert(hashstr)
+            self._add_to_bloom_filter(hashstr)
             self.maintain()
 
     # --------------------------------------------------------------------------
     def is_cached(self, hashstr):
-        try:
-            info = self._cached[hashstr]
-            info["access_time"] = time.time()
-            info["hits"] += 1
+        if self._cached.touch(hashstr):
             self._hits_count += 1
             self.maintain()
             return True
-        except KeyError:
-            self._miss_count += 1
-            return False
+        self._miss_count += 1
+        return False
+
+    # --------------------------------------------------------------------------
+    def is_cached_many(self, hashstrs):
+        return {
+            hashstr: self.is_valid_hash(hashstr) is not None and self.is_cached(hashstr)
+            for hashstr in hashstrs
+        }
+
+    # --------------------------------------------------------------------------
+    def get_cached_data_many(self, hashstrs):
+        result = {}
+        for hashstr in hashstrs:
+            data = None
+            if self.is_valid_hash(hashstr) is not None and hashstr in self._cached:
+                data = CacheFile(hashstr).load()
+                if data is None:
+                    # the file was removed, the hash is no longer cached
+                    self._cached.remove(hashstr)
+            if data is not None:
+                self._cached.touch(hashstr)
+                self._hits_count += 1
+            else:
+                self._miss_count += 1
+            result[hashstr] = data
+        self.maintain()
+        return result
 
     # --------------------------------------------------------------------------
     def _gather_values(self, getters):
@@ -549,6 +914,11 @@ class ClangTidyCache(object):
     def auth_key_writes(self):
         return self._auth_key_writes
 
+    # --------------------------------------------------------------------------
+    @property
+    def output_dict_path(self):
+        return self._output_dict_path
+
     # --------------------------------------------------------------------------
     def save_file_size(self):
         try: return os.path.getsize(self.save_path())
@@ -589,8 +959,8 @@ class ClangTidyCache(object):
     # --------------------------------------------------------------------------
     def total_hit_rate(self):
         try:
-            hits = sum(i["hits"] - 1 for h, i in self._cached.items())
-            total = sum(i["hits"] for h, i in self._cached.items())
+            total = sum(self._cached.hits())
+            hits = total - len(self._cached)
             return hits / total
         except ZeroDivisionError:
             return None
@@ -612,28 +982,24 @@ class ClangTidyCache(object):
     # --------------------------------------------------------------------------
     def hit_count_histogram(self):
         result = dict()
-        for hashstr, info in self._cached.items():
+        for hit_count in self._cached.hits():
             try:
-                hit_count = info["hits"]
-                try:
-                    result[hit_count] += 1
-                except KeyError:
-                    result[hit_count] = 1
-            except: pass
+                result[hit_count] += 1
+            except KeyError:
+                result[hit_count] = 1
 
         return result
 
     # --------------------------------------------------------------------------
     def age_days_histogram(self):
         result = dict()
-        for hashstr, info in self._cached.items():
+        now = time.time()
+        for insert_time in self._cached.insert_times():
+            age_days = int(round((now - insert_time) / (24*3600)))
             try:
-                age_days = int(round((time.time() - info["insert_time"]) / (24*3600)))
-                try:
-                    result[age_days] += 1
-                except KeyError:
-                    result[age_days] = 1
-            except: pass
+                result[age_days] += 1
+            except KeyError:
+                result[age_days] = 1
 
         return result
 
@@ -888,6 +1254,40 @@ def ctc_cache(hashstr):
 def ctc_is_cached(hashstr):
     return "true" if clang_tidy_cache.is_cached(hashstr) else "false"
 # ------------------------------------------------------------------------------
+@ctcache_app.route("/cache_many", methods=['POST'])
+def ctc_cache_many():
+    # Looks up multiple hashes at once. The request contains a JSON object
+    # with the list of "digests" and the "data" flag. The response maps each
+    # of the digests to a boolean or to the cached data (or null) if requested.
+    request = flask.request.get_json(silent=True)
+    if not isinstance(request, dict):
+        return flask.abort(400)
+    hashstrs = request.get("digests")
+    if not isinstance(hashstrs, list) or len(hashstrs) > 10000 or \
+            not all(isinstance(hashstr, str) for hashstr in hashstrs):
+        return flask.abort(400)
+
+    if request.get("data", False):
+        return flask.jsonify(clang_tidy_cache.get_cached_data_many(hashstrs))
+    return flask.jsonify(clang_tidy_cache.is_cached_many(hashstrs))
+# ------------------------------------------------------------------------------
+@ctcache_app.route("/bloom_filter")
+def ctc_bloom_filter():
+    return flask.Response(
+        clang_tidy_cache.bloom_filter_data(),
+        mimetype="application/octet-stream")
+# ------------------------------------------------------------------------------
+@ctcache_app.route("/output_dict")
+def ctc_output_dict():
+    if not clang_tidy_cache.output_dict_path:
+        return flask.abort(404)
+    try:
+        return flask.send_file(
+            clang_tidy_cache.output_dict_path,
+            mimetype="application/octet-stream")
+    except FileNotFoundError:
+        return flask.abort(404)
+# ------------------------------------------------------------------------------
 @ctcache_app.route("/purge_cache")
 def ctc_purge_cache():
     # Deny GET if auth_key_writes is configured
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+# Copyright (c) 2019-2025 Matus Chochlik
+# Distributed under the Boost Software License, Version 1.0.
+# See accompanying file LICENSE_1_0.txt or copy at
+#  http://www.boost.org/LICENSE_1_0.txt
+"""
+clang-tidy-cache-shim is a minimal client which forwards the command-line
+arguments, environment, working directory and standard streams of a
+clang-tidy-cache invocation to a running clang-tidy-cache worker
+(started with `clang-tidy-cache --worker`) over a Unix domain socket.
+If no worker is reachable, the regular clang-tidy-cache is executed instead.
+"""
+
+import array
+import json
+import os
+import socket
+import stat
+import sys
+from typing import Optional
+
+# ------------------------------------------------------------------------------
+def worker_socket_path() -> str:
+    "Returns the path of the worker socket (see ClangTidyCacheOpts.worker_socket)."
+    path = os.getenv("CTCACHE_WORKER_SOCKET")
+    if path:
+        return path
+    cache_dir = os.getenv("CTCACHE_DIR")
+    if not cache_dir:
+        import getpass
+        try:
+            user = getpass.getuser()
+        except KeyError:
+            user = "unknown"
+        cache_dir = os.path.join("/tmp", "ctcache-" + user)
+    return os.path.join(cache_dir, "worker", "worker.sock")
+
+# ------------------------------------------------------------------------------
+def is_private_socket(path) -> bool:
+    """
+    Checks that the socket and its directory are owned by the current user
+    and that the directory is not accessible by others, because the whole
+    environment (including credentials) is sent to the worker.
+    """
+    try:
+        sock_st = os.stat(path)
+        dir_st = os.stat(os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        return False
+    uid = os.getuid()
+    return stat.S_ISSOCK(sock_st.st_mode) and \
+        sock_st.st_uid == uid and dir_st.st_uid == uid and \
+        stat.S_IMODE(dir_st.st_mode) & 0o077 == 0
+
+# ------------------------------------------------------------------------------
+def forward(args) -> Optional[int]:
+    """
+    Forwards the invocation to the worker and returns the exit code,
+    None if no worker is running.
+    """
+    path = worker_socket_path()
+    if not is_private_socket(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        payload = json.dumps({
+            "args": args,
+            "env": dict(os.environ),
+            "cwd": os.getcwd()
+        }).encode("utf8") + b"\n"
+        fds = array.array("i", [0, 1, 2])
+        sent = sock.sendmsg(
+            [payload],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        sock.sendall(payload[sent:])
+
+        reply = bytes()
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    try:
+        return int(json.loads(reply.decode("utf8"))["returncode"])
+    except (ValueError, KeyError):
+        print("clang-tidy-cache worker failed to handle the request", file=sys.stderr)
+        return 1
+
+# ------------------------------------------------------------------------------
+def fallback(args) -> None:
+    "Replaces this process with the regular clang-tidy-cache."
+    here = os.path.dirname(os.path.realpath(__file__))
+    for name in ["clang_tidy_cache.py", "clang-tidy-cache"]:
+        path = os.path.join(here, name)
+        if os.path.isfile(path):
+            os.execv(sys.executable, [sys.executable, path] + args)
+    print("clang-tidy-cache not found next to {0}".format(here), file=sys.stderr)
+    sys.exit(1)
+
+# ------------------------------------------------------------------------------
+def main():
+    args = sys.argv[1:]
+    returncode = forward(args)
+    if returncode is None:
+        fallback(args)
+    return returncode
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/python3 -B
+# coding=utf8
+# Copyright (c) 2025 Matus Chochlik
+# Distributed under the Boost Software License, Version 1.0.
+# See accompanying file LICENSE_1_0.txt or copy at
+#  http://www.boost.org/LICENSE_1_0.txt
+# ------------------------------------------------------------------------------
+# Measures the memory used by the metadata of the cached hashes in
+# clang-tidy-cache-server (CacheMetadata), compared to the dictionary of
+# per-hash dictionaries used by the previous versions. Each measurement runs
+# in a separate process and reports the growth of its resident set size.
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import subprocess
+# ------------------------------------------------------------------------------
+class ArgParser(argparse.ArgumentParser):
+    # --------------------------------------------------------------------------
+    def _counts(self, x):
+        try:
+            counts = [int(float(c)) for c in x.split(",")]
+            assert all(c > 0 for c in counts)
+            return counts
+        except:
+            self.error("`%s' is not a valid list of entry counts" % str(x))
+
+    # --------------------------------------------------------------------------
+    def __init__(self, **kw):
+        argparse.ArgumentParser.__init__(self, **kw)
+
+        self.add_argument(
+            '-s', '--server',
+            metavar='SERVER-PATH',
+            dest='server_path',
+            type=os.path.realpath,
+            default=os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                os.pardir, "src", "ctcache", "clang_tidy_cache_server.py")
+        )
+
+        self.add_argument(
+            '-n', '--counts',
+            metavar='N1,N2,...',
+            dest='counts',
+            type=self._counts,
+            default=[1000000, 10000000],
+            help="""
+            Comma-separated numbers of cached hashes (1e6,1e7 by default).
+            """
+        )
+
+        self.add_argument(
+            '--skip-legacy',
+            dest='skip_legacy',
+            action="store_true",
+            default=False,
+            help="""
+            Do not measure the previous representation, which needs several
+            gigabytes of memory for ten million hashes.
+            """
+        )
+
+        self.add_argument(
+            '--child',
+            nargs=2,
+            metavar=('KIND', 'COUNT'),
+            dest='child',
+            default=None,
+            help=argparse.SUPPRESS
+        )
+
+# ------------------------------------------------------------------------------
+def resident_size():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# ------------------------------------------------------------------------------
+def measure(options, kind, count):
+    sys.path.insert(0, os.path.dirname(options.server_path))
+    sys.argv = sys.argv[:1]
+    import clang_tidy_cache_server as server
+
+    # the hashes themselves are not part of the measured growth
+    hashstrs = [hashlib.sha1(str(i).encode("ascii")).hexdigest() for i in range(count)]
+    before = resident_size()
+    start = time.perf_counter()
+    if kind == "legacy":
+        cached = dict()
+        for hashstr in hashstrs:
+            cached[hashstr] = {
+                "insert_time": time.time(),
+                "access_time": time.time(),
+                "hits": 1,
+            }
+    else:
+        cached = server.CacheMetadata()
+        for hashstr in hashstrs:
+            cached.insert(hashstr)
+    elapsed = time.perf_counter() - start
+    growth = resident_size() - before
+    print("%-8s %10d entries: %8.1f MiB, %6.1f B/entry, %6.2f s" % (
+        kind, count, growth / 2**20, growth / count, elapsed))
+    sys.stdout.flush()
+
+# ------------------------------------------------------------------------------
+def main():
+    options = ArgParser(prog=os.path.basename(__file__)).parse_args()
+
+    if options.child:
+        measure(options, options.child[0], int(options.child[1]))
+        return 0
+
+    kinds = ["compact"] if options.skip_legacy else ["legacy", "compact"]
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the server module creates its data directories on import
+        env = dict(os.environ, CTCACHE_WEBROOT=work_dir)
+        for count in options.counts:
+            for kind in kinds:
+                subprocess.run(
+                    [sys.executable, os.path.realpath(__file__),
+                     "--server", options.server_path,
+                     "--child", kind, str(count)],
+                    env=env,
+                    check=True)
+    return 0
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/python3 -B
+# coding=utf8
+# Copyright (c) 2025 Matus Chochlik
+# Distributed under the Boost Software License, Version 1.0.
+# See accompanying file LICENSE_1_0.txt or copy at
+#  http://www.boost.org/LICENSE_1_0.txt
+# ------------------------------------------------------------------------------
+# Measures the import and startup time of clang-tidy-cache on the local cache
+# hit path (using python -X importtime) and checks it against a time budget.
+# Exits with a non-zero status if the budget is exceeded.
+
+import os
+import re
+import sys
+import stat
+import time
+import argparse
+import tempfile
+import subprocess
+# ------------------------------------------------------------------------------
+class ArgParser(argparse.ArgumentParser):
+    # --------------------------------------------------------------------------
+    def _positive_float(self, x):
+        try:
+            f = float(x)
+            assert f > 0
+            return f
+        except:
+            self.error("`%s' is not a valid time budget" % str(x))
+
+    # --------------------------------------------------------------------------
+    def _positive_int(self, x):
+        try:
+            i = int(x)
+            assert i > 0
+            return i
+        except:
+            self.error("`%s' is not a valid count" % str(x))
+
+    # --------------------------------------------------------------------------
+    def __init__(self, **kw):
+        argparse.ArgumentParser.__init__(self, **kw)
+
+        self.add_argument(
+            '-c', '--client',
+            metavar='CLIENT-PATH',
+            dest='client_path',
+            type=os.path.realpath,
+            default=os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                os.pardir, "src", "ctcache", "clang_tidy_cache.py")
+        )
+
+        self.add_argument(
+            '-r', '--runs',
+            metavar='NUMBER',
+            dest='runs',
+            type=self._positive_int,
+            default=10
+        )
+
+        self.add_argument(
+            '-i', '--import-budget',
+            metavar='MILLISECONDS',
+            dest='import_budget',
+            type=self._positive_float,
+            default=60.0,
+            help="""
+            Budget for the time spent importing modules after the interpreter
+            startup (median over the runs).
+            """
+        )
+
+        self.add_argument(
+            '-s', '--startup-budget',
+            metavar='MILLISECONDS',
+            dest='startup_budget',
+            type=self._positive_float,
+            default=250.0,
+            help="""
+            Budget for the wall-clock time of a whole cache hit invocation
+            (median over the runs).
+            """
+        )
+
+        self.add_argument(
+            '-t', '--top',
+            metavar='NUMBER',
+            dest='top',
+            type=self._positive_int,
+            default=10,
+            help="""
+            Number of the most expensive imports to print.
+            """
+        )
+
+# ------------------------------------------------------------------------------
+_import_re = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+# ------------------------------------------------------------------------------
+def parse_importtime(stderr):
+    """
+    Returns the list of (self_us, cumulative_us, depth, module) for the modules
+    imported after the interpreter startup (i.e. after the site module).
+    """
+    result = []
+    for line in stderr.splitlines():
+        match = _import_re.match(line)
+        if match:
+            self_us, cumul_us, indent, module = match.groups()
+            depth = (len(indent) - 1) // 2
+            if depth == 0 and module == "site":
+                result = []
+                continue
+            result.append((int(self_us), int(cumul_us), depth, module))
+    return result
+
+# ------------------------------------------------------------------------------
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+# ------------------------------------------------------------------------------
+def prepare(work_dir):
+    fake_ct = os.path.join(work_dir, "clang-tidy")
+    marker = os.path.join(work_dir, "clang-tidy-ran")
+    with open(fake_ct, "w") as f:
+        f.write("#!/bin/sh\n")
+        f.write("for a in \"$@\"; do\n")
+        f.write("  [ \"$a\" = \"--dump-config\" ] && echo \"Checks: '*'\" && exit 0\n")
+        f.write("done\n")
+        f.write("echo >> '%s'\n" % marker)
+    os.chmod(fake_ct, os.stat(fake_ct).st_mode | stat.S_IXUSR)
+    # created upfront so that the first run does not modify the directory
+    open(marker, "w").close()
+
+    source = os.path.join(work_dir, "test.cpp")
+    with open(source, "w") as f:
+        f.write("int main() { return 0; }\n")
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith("CTCACHE_")}
+    env["CTCACHE_DIR"] = os.path.join(work_dir, "cache")
+    return [fake_ct, source, "--"], marker, env
+
+# ------------------------------------------------------------------------------
+def main():
+    options = ArgParser(prog=os.path.basename(__file__)).parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        args, marker, env = prepare(work_dir)
+        command = [sys.executable, options.client_path] + args
+
+        # the first run populates the cache
+        subprocess.run(command, env=env, cwd=work_dir, check=True)
+        ct_runs = os.path.getsize(marker)
+
+        wall_times = []
+        import_times = []
+        imports = {}
+        for _ in range(options.runs):
+            start = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime"] + command[1:],
+                env=env,
+                cwd=work_dir,
+                stderr=subprocess.PIPE,
+                check=True)
+            wall_times.append((time.perf_counter() - start) * 1000.0)
+            if os.path.getsize(marker) != ct_runs:
+                print("clang-tidy was executed, the invocation is not a cache hit")
+                return 2
+            parsed = parse_importtime(proc.stderr.decode("utf8"))
+            import_times.append(sum(i[0] for i in parsed) / 1000.0)
+            for self_us, cumul_us, depth, module in parsed:
+                if depth == 0:
+                    imports.setdefault(module, []).append(cumul_us / 1000.0)
+
+    import_time = median(import_times)
+    wall_time = median(wall_times)
+
+    print("Most expensive top-level imports (median cumulative time):")
+    top = sorted(((median(t), m) for m, t in imports.items()), reverse=True)
+    for t, module in top[:options.top]:
+        print("  %-32s %7.2f ms" % (module, t))
+    print("Import time:  %7.2f ms (budget %7.2f ms)" % (import_time, options.import_budget))
+    print("Startup time: %7.2f ms (budget %7.2f ms)" % (wall_time, options.startup_budget))
+
+    if import_time > options.import_budget or wall_time > options.startup_budget:
+        print("Startup time budget exceeded")
+        return 1
+    return 0
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/python3 -B
+# coding=utf8
+# Copyright (c) 2025 Matus Chochlik
+# Distributed under the Boost Software License, Version 1.0.
+# See accompanying file LICENSE_1_0.txt or copy at
+#  http://www.boost.org/LICENSE_1_0.txt
+# ------------------------------------------------------------------------------
+# Builds a preset dictionary for the compression of the cached clang-tidy
+# outputs (see CTCACHE_COMPRESS_OUTPUT) from sample outputs, either from files
+# or from the entries of a (file-based) local cache. The dictionary consists
+# of the lines shared by the most samples, the most valuable ones last,
+# because zlib encodes references to the end of the dictionary most cheaply.
+
+import os
+import re
+import sys
+import argparse
+# ------------------------------------------------------------------------------
+class ArgParser(argparse.ArgumentParser):
+    # --------------------------------------------------------------------------
+    def _positive_int(self, x):
+        try:
+            i = int(x)
+            assert i > 0
+            return i
+        except:
+            self.error("`%s' is not a valid size" % str(x))
+
+    # --------------------------------------------------------------------------
+    def __init__(self, **kw):
+        argparse.ArgumentParser.__init__(self, **kw)
+
+        self.add_argument(
+            '-o', '--output',
+            metavar='FILE-PATH',
+            dest='output_path',
+            default="output.zdict",
+            help="""
+            Path of the created dictionary, clang-tidy-cache reads it from
+            output.zdict in the cache directory or from CTCACHE_OUTPUT_DICT.
+            """
+        )
+
+        self.add_argument(
+            '-c', '--cache-dir',
+            metavar='DIR-PATH',
+            dest='cache_dir',
+            default=None,
+            help="""
+            Use the outputs stored in the local cache directory as samples.
+            """
+        )
+
+        self.add_argument(
+            '-s', '--size',
+            metavar='BYTES',
+            dest='size',
+            type=self._positive_int,
+            default=32 * 1024,
+            help="""
+            Maximal size of the dictionary (zlib uses at most 32 KiB).
+            """
+        )
+
+        self.add_argument(
+            'samples',
+            metavar='FILE',
+            nargs='*',
+            help="""
+            Files with sample clang-tidy outputs.
+            """
+        )
+
+# ------------------------------------------------------------------------------
+_shard_re = re.compile(r'^[0-9a-f]{2}$')
+_hash_re = re.compile(r'^[0-9a-f]{30,62}(-[0-9a-z]+)?$')
+# ------------------------------------------------------------------------------
+def cached_samples(cache_dir):
+    for shard in os.listdir(cache_dir):
+        shard_dir = os.path.join(cache_dir, shard)
+        if not _shard_re.match(shard) or not os.path.isdir(shard_dir):
+            continue
+        for filename in os.listdir(shard_dir):
+            if _hash_re.match(filename):
+                with open(os.path.join(shard_dir, filename), "rb") as f:
+                    data = f.read()
+                # skip the return code, compressed outputs are not usable
+                if len(data) > 1 and not data.startswith(b"\x89CTZ"):
+                    yield data[1:]
+
+# ------------------------------------------------------------------------------
+def file_samples(paths):
+    for path in paths:
+        with open(path, "rb") as f:
+            yield f.read()
+
+# ------------------------------------------------------------------------------
+def build_dictionary(samples, size):
+    counts = {}
+    for sample in samples:
+        for line in set(sample.splitlines(keepends=True)):
+            counts[line] = counts.get(line, 0) + 1
+
+    # the lines occurring in multiple samples, by the bytes they would save
+    lines = sorted(
+        (line for line, count in counts.items() if count > 1),
+        key=lambda line: counts[line] * len(line),
+        reverse=True)
+    chosen = []
+    total = 0
+    for line in lines:
+        if total + len(line) > size:
+            continue
+        chosen.append(line)
+        total += len(line)
+    return bytes().join(reversed(chosen))
+
+# ------------------------------------------------------------------------------
+def main():
+    options = ArgParser(prog=os.path.basename(__file__)).parse_args()
+
+    samples = list(file_samples(options.samples))
+    if options.cache_dir:
+        samples += list(cached_samples(options.cache_dir))
+    if not samples:
+        print("No samples found")
+        return 1
+
+    dictionary = build_dictionary(samples, options.size)
+    with open(options.output_path, "wb") as f:
+        f.write(dictionary)
+    print("Dictionary of %d bytes built from %d samples" % (len(dictionary), len(samples)))
+    return 0
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())